@@ -0,0 +1,194 @@
+import os
+import sys
+import types
+import zlib
+import random
+import shutil
+import argparse
+import tarfile
+import zipfile
+import concurrent.futures
+from datetime import datetime
+from submain import log, new_hash
+from catalog import open_tar_stream, tar_member_key
+
+# Check of a zip right after it was written, without re-reading all of it like ZipFile.testzip():
+# the writers compute the CRC-32 and size of every member from the data they read, apart from the
+# CRC zipfile puts in the headers, the central directory read back has to match them, and a sample of the members is read back (CRC checked by zipfile,
+# content hash compared when it is known) by parallel readers.
+# archive_verify = full reads back every member instead, the scrub the old testzip() check did.
+
+FULL = "full"
+READ_SIZE = 1024 * 1024
+
+# Hands a file to a zip writer and computes the CRC-32 and size of the data read on the way
+class CrcReader:
+    def __init__(self, file):
+        self.file = file
+        self.crc = 0
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        return data
+
+    def checksum(self):
+        return self.crc, self.size
+
+# Stream file into zip_file as the stored member info (from ZipInfo.from_file); returns the
+# (crc, size) of the data read from file
+def write_stored_member(zip_file, info, file, buffer_size):
+    info.compress_type = zipfile.ZIP_STORED
+    reader = CrcReader(file)
+    with zip_file.open(info, mode='w', force_zip64=info.file_size >= zipfile.ZIP64_LIMIT) as member:
+        shutil.copyfileobj(reader, member, buffer_size)
+    return reader.checksum()
+
+# Differences between the central directory and the values captured while writing
+def check_central_directory(infos, expected, archive_size):
+    problems = []
+    found = set()
+    for info in infos:
+        found.add(info.filename)
+        if info.filename not in expected:
+            problems.append(f"{info.filename} was not written")
+        elif expected[info.filename] != (info.CRC, info.file_size):
+            problems.append(f"{info.filename} has CRC {info.CRC:08x} and size {info.file_size}, "
+                            f"{expected[info.filename][0]:08x} and {expected[info.filename][1]} were written")
+        if info.header_offset + info.compress_size > archive_size:
+            problems.append(f"{info.filename} ends past the end of the archive")
+    problems += [f"{name} is missing" for name in expected.keys() - found]
+    return problems
+
+# Pick count members to read back: the first and the last one written and a random rest
+def sample_members(infos, count):
+    if len(infos) <= count:
+        return infos
+    picked = {id(info): info for info in (infos[0], infos[-1])}
+    rest = [info for info in infos if id(info) not in picked]
+    for info in random.sample(rest, max(count - len(picked), 0)):
+        picked[id(info)] = info
+    return list(picked.values())
+
+# Read members back through zipfile, which checks every CRC at the end of a member, and compare
+# the content hash where hashes has one. Returns the problems found.
+def read_members(archive_path, infos, hashes=None, algorithm=None):
+    problems = []
+    with zipfile.ZipFile(archive_path) as zip_file:
+        for info in infos:
+            expected_hash = hashes.get(info.filename) if hashes else None
+            file_hash = new_hash(algorithm) if expected_hash else None
+            try:
+                with zip_file.open(info) as member:
+                    while True:
+                        chunk = member.read(READ_SIZE)
+                        if not chunk:
+                            break
+                        if file_hash is not None:
+                            file_hash.update(chunk)
+            except (zipfile.BadZipFile, OSError, EOFError, ValueError) as err:
+                problems.append(f"{info.filename}: {err}")
+                continue
+            if file_hash is not None and file_hash.hexdigest() != expected_hash:
+                problems.append(f"{info.filename} doesn't match its content hash")
+    return problems
+
+# Read the members back with workers threads, each with its own handle on the archive
+def read_members_parallel(archive_path, infos, workers, hashes=None, algorithm=None):
+    workers = max(min(workers or os.cpu_count() or 1, len(infos)), 1)
+    # Largest first over the readers, so one big member doesn't end up last
+    shares = [[] for _ in range(workers)]
+    for n, info in enumerate(sorted(infos, key=lambda info: info.file_size, reverse=True)):
+        shares[n % workers].append(info)
+    problems = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(lambda share: read_members(archive_path, share, hashes, algorithm), shares):
+            problems += result
+    return problems
+
+# Verify a zip against expected, {member name: (crc, size)} captured while writing it (None for
+# an archive written earlier: nothing to compare the central directory with); hashes optionally
+# maps member names to the content hash (config.hash_algorithm) of the file written.
+# Returns True when the archive is good.
+def verify_zip(archive_path, expected, config, hashes=None):
+    start_time_verify = datetime.now()
+    try:
+        with zipfile.ZipFile(archive_path) as zip_file:
+            infos = [info for info in zip_file.infolist() if not info.is_dir()]
+        problems = check_central_directory(infos, expected, os.path.getsize(archive_path)) if expected is not None else []
+        if not problems:
+            infos = infos if config.archive_verify == FULL else sample_members(infos, config.archive_verify_sample)
+            algorithm = config.hash_algorithm if hashes else None
+            problems = read_members_parallel(archive_path, infos, config.archive_verify_workers, hashes, algorithm)
+    except (zipfile.BadZipFile, OSError) as err:
+        problems = [str(err)]
+    if problems:
+        for problem in problems[:20]:
+            log(f"{archive_path}: {problem}", "Failure")
+        log(f"{archive_path} failed the archive check ({len(problems)} problems).", "Failure")
+        return False
+    duration_str = str(datetime.now() - start_time_verify).split('.')[0]  # Remove the fractional seconds
+    log(f"Archive verified ({config.archive_verify}): {len(infos)} members read back, duration: {duration_str}", "Success")
+    return True
+
+# Verify a .tar.lz4 or .tar.zst right after it was written. Its members are one compressed stream,
+# so the whole stream is decompressed: every member of expected, {key: size} with the key the
+# path under the session folder, has to be there with that size, and the content hash in hashes
+# (keyed the same way) is compared for every member with archive_verify = full, for a sample of
+# archive_verify_sample members otherwise. Returns True when the archive is good.
+def verify_tar(archive_path, expected, config, hashes=None):
+    start_time_verify = datetime.now()
+    keys = list(expected)
+    if config.archive_verify == FULL:
+        compared = set(keys)
+    else:
+        compared = set(random.sample(keys, min(config.archive_verify_sample, len(keys))))
+    problems = []
+    found = set()
+    try:
+        with open_tar_stream(archive_path) as stream:
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                for info in tar:
+                    if not info.isfile():
+                        continue
+                    key = tar_member_key(info)
+                    found.add(key)
+                    if key in expected and expected[key] != info.size:
+                        problems.append(f"{key} has size {info.size}, {expected[key]} was written")
+                    expected_hash = hashes.get(key) if hashes and key in compared else None
+                    if expected_hash is None:
+                        continue
+                    file_hash = new_hash(config.hash_algorithm)
+                    member = tar.extractfile(info)
+                    while True:
+                        chunk = member.read(READ_SIZE)
+                        if not chunk:
+                            break
+                        file_hash.update(chunk)
+                    if file_hash.hexdigest() != expected_hash:
+                        problems.append(f"{key} doesn't match its content hash")
+    # lz4 and zstandard raise their own errors on a damaged frame
+    except Exception as err:
+        problems.append(str(err))
+    problems += [f"{key} is missing" for key in expected.keys() - found]
+    if problems:
+        for problem in problems[:20]:
+            log(f"{archive_path}: {problem}", "Failure")
+        log(f"{archive_path} failed the archive check ({len(problems)} problems).", "Failure")
+        return False
+    duration_str = str(datetime.now() - start_time_verify).split('.')[0]  # Remove the fractional seconds
+    log(f"Archive verified ({config.archive_verify}): {len(found)} members read back, "
+        f"{len(compared & found) if hashes else 0} compared with their content hash, duration: {duration_str}", "Success")
+    return True
+
+# Full scrub of existing archives on demand: python archive_verify.py <archive.zip> ...
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read back every member of zip backups and check their CRCs")
+    parser.add_argument('archives', nargs='+')
+    parser.add_argument('--workers', type=int, default=0, help="parallel readers (default: one per core)")
+    args = parser.parse_args()
+    config = types.SimpleNamespace(archive_verify=FULL, archive_verify_sample=0, archive_verify_workers=args.workers, hash_algorithm=None)
+    results = [verify_zip(archive_path, None, config) for archive_path in args.archives]
+    sys.exit(0 if all(results) else 1)
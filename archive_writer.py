@@ -0,0 +1,202 @@
+import os
+import io
+import time
+import zlib
+import tarfile
+import zipfile
+from datetime import datetime
+from parallel_zip import ParallelZipWriter
+from compressibility import load_policy, save_policy
+from archive_verify import verify_zip, verify_tar, write_stored_member
+from parallel_lz4 import ParallelLZ4Writer
+from zstd_archive import ZstdArchiveWriter, train_dictionary, record_dictionary
+from submain import (log, new_hash, hash_path_stats, staging_relative_path, plan_one_pass_copy, index_copied_hash,
+                     record_content_index, duplicates_manifest, DUPLICATES_MANIFEST)
+
+# Hands a snapshot file to the archive writer and, when the file has no hash yet, hashes every
+# block on its way into the archive
+class HashingReader:
+    def __init__(self, file, algorithm=None):
+        self.file = file
+        self.hash = new_hash(algorithm) if algorithm is not None else None
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        if self.hash is not None:
+            self.hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest() if self.hash is not None else None
+
+# Writes members straight into a zip (stored like create_zip_file_from_folder, or deflated by the
+# parallel writer with zip_compression_level, which stores already compressed files when
+# zip_skip_incompressible is set) or a tar.lz4 (members under the session folder name, like
+# create_lz4_file_from_folder) and keeps their offsets, keyed like read_archive_members, so the
+# archive isn't read back for the catalog.
+# The tar.lz4 is compressed in blocks by lz4_workers threads; a tar.zst by zstd's threads, with a
+# dictionary trained from sample_files, (path, size) pairs, when zstd_dictionary is set.
+class DirectArchive:
+    def __init__(self, archive_path, archive_format, session_name, config, sample_files=()):
+        self.archive_format = archive_format
+        self.session_name = session_name
+        self.buffer_size = config.buffer_size
+        self.members = {}
+        # arcname -> (crc, size) of the stored zip members, computed from the data written
+        self.checksums = {}
+        self.parallel = None
+        self.dictionary = None
+        self.policy = None
+        if archive_format == 'zip' and config.zip_compression_level > 0:
+            if config.zip_skip_incompressible:
+                self.policy = load_policy(config)
+            self.parallel = ParallelZipWriter(archive_path, config.zip_compression_level, config.zip_workers, config.buffer_size, self.policy)
+            self.members = self.parallel.members
+        elif archive_format == 'zip':
+            self.zip_file = zipfile.ZipFile(archive_path, mode='w', allowZip64=True)
+        elif archive_format == '.tar.lz4':
+            self.stream = ParallelLZ4Writer(archive_path, config.lz4_block_size, config.lz4_workers)
+            self.tar = tarfile.open(fileobj=self.stream, mode='w')
+        elif archive_format == '.tar.zst':
+            if config.zstd_dictionary:
+                self.dictionary = train_dictionary(sample_files, config.zstd_dict_size, config.zstd_dict_samples)
+            self.stream = ZstdArchiveWriter(archive_path, config.zstd_level, config.zstd_threads, self.dictionary)
+            self.tar = tarfile.open(fileobj=self.stream, mode='w')
+        else:
+            raise ValueError(f"Unsupported archive format: {archive_format}")
+
+    # Add one file under the member name key; returns the hash computed on the way, if any
+    def add_file(self, src, key, algorithm=None):
+        with open(src, 'rb') as f:
+            reader = HashingReader(f, algorithm)
+            if self.archive_format == 'zip':
+                info = zipfile.ZipInfo.from_file(src, arcname=key)
+                self.checksums[info.filename] = write_stored_member(self.zip_file, info, reader, self.buffer_size)
+                self.members[key] = (info.filename, info.header_offset, info.compress_size)
+            else:
+                info = self.tar.gettarinfo(src, arcname=self.session_name + '/' + key, fileobj=f)
+                self.tar.addfile(info, fileobj=reader)
+                # addfile leaves the stream offset after the data padded to whole blocks
+                padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                self.members[key] = (info.name, self.tar.offset - padded, info.size)
+        return reader.hexdigest()
+
+    # Add files given as (index, src, key, algorithm, size); yields (index, file_hash, error) for
+    # every file, a file that couldn't be read is left out
+    def add_files(self, entries):
+        if self.parallel is not None:
+            yield from self.parallel.write_files(entries)
+            return
+        for index, src, key, algorithm, size in entries:
+            try:
+                file_hash = self.add_file(src, key, algorithm)
+            except (FileNotFoundError, PermissionError) as err:
+                yield index, None, err
+                continue
+            yield index, file_hash, None
+
+    def add_bytes(self, key, data):
+        if self.parallel is not None:
+            self.parallel.writestr(key, data)
+        elif self.archive_format == 'zip':
+            self.zip_file.writestr(key, data, compress_type=zipfile.ZIP_STORED)
+            self.checksums[key] = (zlib.crc32(data), len(data))
+        else:
+            info = tarfile.TarInfo(self.session_name + '/' + key)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.tar.addfile(info, fileobj=io.BytesIO(data))
+
+    def close(self):
+        if self.parallel is not None:
+            self.parallel.close()
+        elif self.archive_format == 'zip':
+            self.zip_file.close()
+        else:
+            self.tar.close()
+            self.stream.close()
+
+    # The check create_zip_file_from_folder runs on its archive: verify_zip against the CRCs
+    # computed while writing. A tar stream has no member checksums, it is read back by verify_tar
+    # against the member sizes and content hashes.
+    def verify(self, archive_path, config, hashes=None):
+        if self.archive_format != 'zip':
+            return verify_tar(archive_path, {key: size for key, (name, offset, size) in self.members.items()}, config, hashes)
+        expected = self.parallel.checksums if self.parallel is not None else self.checksums
+        return verify_zip(archive_path, expected, config, hashes)
+
+# direct_archive mode: the files are read from the snapshot mount and written straight into the
+# archive, without a staging folder. With hash_files (fused_copy_hash) the files whose hash isn't
+# known are hashed as they are written; a duplicate only found then stays in the archive but is
+# recorded as a reference like any other duplicate.
+# Returns (status, {hash: details} like copy_files_pool, archive members).
+def write_archive_direct(indices, archive_path, archive_format, session_name, config, hash_files=False):
+    log(f"Writing files from the snapshot straight into {archive_path}...", "Attempt")
+    start_time_archive = datetime.now()
+    store = config.backup_files
+    if hash_files:
+        hash_cache, first_by_hash, duplicates, to_write = plan_one_pass_copy(indices, config)
+    else:
+        hash_cache, first_by_hash, duplicates, to_write = None, None, [], indices
+    return_dict = {}
+    stored = []
+    # Member name -> content hash, for the spot-check of the archive
+    hashes = {}
+    archive = None
+    try:
+        sample_files = ()
+        if archive_format == '.tar.zst' and config.zstd_dictionary:
+            sample_files = [(store.path(index), store.sizes[index]) for index in to_write]
+        archive = DirectArchive(archive_path, archive_format, session_name, config, sample_files)
+        entries = ((index, store.path(index), staging_relative_path(store.drive(index), store.path(index)).replace("\\", "/"),
+                    config.hash_algorithm if store.hashes[index] is None else None, store.sizes[index]) for index in to_write)
+        start = time.perf_counter()
+        for index, file_hash, err in archive.add_files(entries):
+            src = store.path(index)
+            if isinstance(err, FileNotFoundError):
+                log(f"Error: Path not found in the latest VSS snapshot: {src}", "failure")
+                continue
+            elif err is not None:
+                log(f"Error: {err}", "failure")
+                continue
+            if file_hash is not None:
+                # Time since the previous file: the writer's throughput once files are compressed in parallel
+                now = time.perf_counter()
+                hash_path_stats.record("archive+hash", store.sizes[index], now - start)
+                start = now
+                if not index_copied_hash(store, index, file_hash, first_by_hash, duplicates, hash_cache):
+                    continue
+            stored.append(index)
+            hashes[staging_relative_path(store.drive(index), src).replace("\\", "/")] = store.hashes[index]
+            return_dict[store.hashes[index]] = {"status": "Y", "drive": store.drive(index), "file": src, "mtime": store.mtimes[index], "size": store.sizes[index]}
+        if hash_files:
+            record_content_index(config, stored, duplicates, first_by_hash)
+            hash_path_stats.report()
+        manifest = duplicates_manifest(config, return_dict)
+        if manifest is not None:
+            archive.add_bytes(DUPLICATES_MANIFEST, manifest)
+        archive.close()
+        if archive.dictionary is not None:
+            record_dictionary(config, archive_path, archive.dictionary)
+        if archive.policy is not None:
+            save_policy(config, archive.policy)
+            log(f"Compression decisions: {archive.policy.summary()}", "INFORMA")
+    except Exception as e:
+        log(f"Error writing {archive_path}: {e}", "Failure")
+        if archive is not None:
+            try:
+                archive.close()
+            except Exception:
+                pass
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+        return False, return_dict, {}
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+    duration = datetime.now() - start_time_archive
+    duration_str = str(duration).split('.')[0]  # Remove the fractional seconds
+    log(f"Wrote {len(stored)} files into the archive, duration: {duration_str}", "Success")
+    if not archive.verify(archive_path, config, hashes):
+        return False, return_dict, {}
+    return True, return_dict, archive.members
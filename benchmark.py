@@ -0,0 +1,560 @@
+import argparse
+import gc
+import itertools
+import os
+import sqlite3
+import time
+import types
+import shutil
+import tempfile
+import tracemalloc
+import concurrent.futures
+from record_store import FileRecordStore
+
+# Benchmarks for the backup engine.
+# Run one with: python benchmark.py <name> [--sizes ...]
+
+def synthetic_files(count):
+    # About 50 files per folder, the usual shape of a user profile
+    for i in range(count):
+        yield ("C:", f"c:\\mount\\snapshot_C\\Users\\user\\Documents\\project{i // 1000}\\part{i // 50 % 20}\\file{i}.docx",
+               1700000000.0 + i, 1000 + i % 100000)
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    build_time = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # A full collection walks every tracked container, which is what the GC pauses cost
+    start = time.perf_counter()
+    gc.collect()
+    gc_time = time.perf_counter() - start
+    return result, current, build_time, gc_time
+
+# Memory of config.backup_files as dict-of-dicts against the FileRecordStore
+def bench_record_store(sizes):
+    sizes = sizes or [1000000, 5000000]
+    for count in sizes:
+        def build_dict():
+            backup_files = {}
+            for drive, path, mtime, size in synthetic_files(count):
+                backup_files[path] = {'drive': drive, 'mtime': mtime, 'size': size}
+            return backup_files
+
+        def build_store():
+            store = FileRecordStore()
+            for drive, path, mtime, size in synthetic_files(count):
+                store.add(drive, path, mtime, size)
+            return store
+
+        for name, build in (("dict-of-dicts", build_dict), ("FileRecordStore", build_store)):
+            result, used, build_time, gc_time = measure(build)
+            print(f"{name:16} {count:>9} files: {used / 1024 / 1024:8.1f} MB ({used / count:6.1f} bytes/file), "
+                  f"build {build_time:6.1f}s, full GC {gc_time * 1000:7.1f} ms")
+            del result
+
+# Synthetic tree of small files plus a few large ones, returned as a FileRecordStore
+def make_test_tree(root, num_small, num_large, small_size=4096, large_size=64 * 1024 * 1024):
+    store = FileRecordStore()
+    block = os.urandom(1024 * 1024)
+    for i in range(num_small):
+        folder = os.path.join(root, f"small{i // 500}")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"file{i}.xml")
+        with open(path, "wb") as f:
+            f.write(block[i % 1024:i % 1024 + small_size])
+        stat = os.stat(path)
+        store.add("C:", path, stat.st_mtime, stat.st_size, stat.st_ino)
+    for i in range(num_large):
+        path = os.path.join(root, f"large{i}.pst")
+        with open(path, "wb") as f:
+            for _ in range(large_size // len(block)):
+                f.write(block)
+        stat = os.stat(path)
+        store.add("C:", path, stat.st_mtime, stat.st_size, stat.st_ino)
+    return store
+
+def bench_config(store, **options):
+    config = types.SimpleNamespace(max_threads=os.cpu_count() or 4, buffer_size=4 * 1024 * 1024, backup_files=store,
+                                   hash_processes=0, small_file_limit=1024 * 1024, mmap_threshold=0,
+                                   archive_verify="quick", archive_verify_sample=32, archive_verify_workers=0,
+                                   hash_algorithm="xxh3_128")
+    config.__dict__.update(options)
+    return config
+
+def report(name, store, elapsed):
+    total = store.total_size()
+    print(f"{name:28} {len(store):>7} files {total / 1048576:8.0f} MB in {elapsed:6.2f}s: "
+          f"{total / 1048576 / elapsed:8.1f} MB/s {len(store) / elapsed:9.0f} files/s")
+
+# Per-file thread pool hashing (hash_engine = threads) against the adaptive engine
+def bench_hashing(sizes):
+    from submain import generate_hash
+    from hash_engine import hash_files_adaptive
+    sizes = sizes or [20000]
+    for num_small in sizes:
+        root = tempfile.mkdtemp(prefix="backup_bench_")
+        try:
+            store = make_test_tree(root, num_small, 4)
+            config = bench_config(store)
+            indices = range(len(store))
+
+            # The current implementation: one future per file
+            start = time.perf_counter()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=config.max_threads) as executor:
+                futures = [executor.submit(generate_hash, store.path(index), config) for index in indices]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            report("threads, one task per file", store, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for _ in hash_files_adaptive(store, indices, config):
+                pass
+            report("adaptive, threads", store, time.perf_counter() - start)
+
+            config.hash_processes = os.cpu_count() or 4
+            start = time.perf_counter()
+            for _ in hash_files_adaptive(store, indices, config):
+                pass
+            report("adaptive, process batches", store, time.perf_counter() - start)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+def peak_rss():
+    import psutil
+    memory = psutil.Process().memory_info()
+    if hasattr(memory, 'peak_wset'):
+        return memory.peak_wset
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Runs in a fresh process so the peak RSS belongs to one read path only
+def _hash_paths_worker(paths, method, buffer_size):
+    import xxhash
+    from submain import hash_file
+    start = time.perf_counter()
+    for path in paths:
+        if method == "read":
+            # The old generate_hash loop, a new bytes object per block
+            file_hash = xxhash.xxh64()
+            with open(path, "rb") as f:
+                for byte_block in iter(lambda: f.read(buffer_size), b""):
+                    file_hash.update(byte_block)
+        elif method == "readinto":
+            hash_file(path, buffer_size, 0, "xxh64")
+        else:
+            hash_file(path, buffer_size, 1, "xxh64")
+    return time.perf_counter() - start, peak_rss()
+
+# read() against readinto and mmap on large files, throughput and peak RSS per path
+def bench_hash_paths(sizes):
+    sizes = sizes or [4]
+    buffer_size = 8 * 1024 * 1024
+    for num_large in sizes:
+        root = tempfile.mkdtemp(prefix="backup_bench_")
+        try:
+            store = make_test_tree(root, 0, num_large, large_size=256 * 1024 * 1024)
+            paths = [store.path(index) for index in range(len(store))]
+            for method in ("read", "readinto", "mmap"):
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+                    elapsed, peak = executor.submit(_hash_paths_worker, paths, method, buffer_size).result()
+                report(method, store, elapsed)
+                print(f"{'':28} peak RSS {peak / 1048576:.0f} MB")
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+# Local files under path as a FileRecordStore, up to limit files
+def load_local_tree(path, limit):
+    store = FileRecordStore()
+    for dir_path, dir_names, file_names in os.walk(path):
+        for name in file_names:
+            file_path = os.path.join(dir_path, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            store.add("C:", file_path, stat.st_mtime, stat.st_size, stat.st_ino)
+            if len(store) >= limit:
+                return store
+    return store
+
+# Throughput of every hash_algorithm over the same files, local data with --path.
+# One untimed pass first so every algorithm reads from the page cache and only hashing differs.
+def bench_hash_algorithms(sizes, path=None):
+    from submain import hash_file, new_hash
+    sizes = sizes or [20000]
+    for num_files in sizes:
+        root = None
+        if path:
+            store = load_local_tree(path, num_files)
+        else:
+            root = tempfile.mkdtemp(prefix="backup_bench_")
+            store = make_test_tree(root, num_files, 4)
+        try:
+            paths = [store.path(index) for index in range(len(store))]
+            for file_path in paths:
+                try:
+                    hash_file(file_path, 4 * 1024 * 1024, 0, "xxh64")
+                except OSError:
+                    pass
+            for algorithm in ("xxh64", "xxh3_64", "xxh3_128", "blake3"):
+                try:
+                    new_hash(algorithm)
+                except ImportError:
+                    print(f"{algorithm:28} not installed")
+                    continue
+                start = time.perf_counter()
+                for file_path in paths:
+                    try:
+                        hash_file(file_path, 4 * 1024 * 1024, 0, algorithm)
+                    except OSError:
+                        pass
+                report(algorithm, store, time.perf_counter() - start)
+        finally:
+            if root:
+                shutil.rmtree(root, ignore_errors=True)
+
+# Synthetic catalog history: runs of 100000 files, the newest run last
+def catalog_history(count, start=0):
+    for i in range(start, count):
+        run, file_number = divmod(i, 100000)
+        yield (f"{20200101 + run}", f"c:\\mount\\snapshot_C\\Users\\user\\file{file_number}.docx", f"{i:032x}",
+               f"{1700000000.0 + i}", f"{1000 + file_number}", None, "xxh3_128")
+
+# The same history written run by run through the catalog layer
+def write_history(conn, count, start=0):
+    from catalog import write_run
+    for date, rows in itertools.groupby(catalog_history(count, start), key=lambda row: row[0]):
+        write_run(conn, date, "full", None, "xxh3_128",
+                  ((file, file_hash, mtime, size, ref, None) for date, file, file_hash, mtime, size, ref, algo in rows), {})
+
+def join_current_files(db_name, count):
+    # The scan of the current files: half of them unchanged since the newest run
+    tracker = sqlite3.connect(":memory:")
+    tracker.execute("CREATE TABLE backutil_tracker(drive TEXT, file TEXT, hash TEXT, mtime TEXT,size TEXT, idx INTEGER, dup_of TEXT);")
+    newest = count - min(count, 100000)
+    rows = []
+    for idx, row in enumerate(catalog_history(count, newest), newest):
+        date, file, file_hash, mtime, size, ref, algo = row
+        if idx % 2:
+            file_hash = "changed" + file_hash
+        rows.append(("C:", file, file_hash, mtime, size, idx))
+    tracker.executemany("INSERT INTO backutil_tracker (drive, file, hash, mtime, size, idx) VALUES (?, ?, ?, ?, ?, ?);", rows)
+    tracker.commit()
+    tracker.execute("ATTACH ? as backutil_previous", (db_name,))
+    start = time.perf_counter()
+    changed = 0
+    for line in tracker.execute(
+            "SELECT backutil_tracker.drive, backutil_tracker.file, backutil_tracker.hash, backutil_tracker.mtime,backutil_tracker.size, backutil_previous.date, backutil_tracker.idx FROM backutil_tracker LEFT JOIN backutil_previous ON backutil_tracker.hash=backutil_previous.hash AND backutil_tracker.mtime = backutil_previous.mtime AND backutil_tracker.size = backutil_previous.size WHERE backutil_tracker.dup_of IS NULL;"):
+        if line[5] is None:
+            changed += 1
+    elapsed = time.perf_counter() - start
+    tracker.close()
+    return elapsed, len(rows), changed
+
+# The same current files checked by the change detector (lookup or merge mode)
+def detect_current_files(db_name, count, merge_rows):
+    from change_detector import find_changed_files
+    store = FileRecordStore()
+    newest = count - min(count, 100000)
+    for idx, row in enumerate(catalog_history(count, newest), newest):
+        date, file, file_hash, mtime, size, ref, algo = row
+        index = store.add("C:", file, float(mtime), int(size))
+        store.hashes[index] = "changed" + file_hash if idx % 2 else file_hash
+    config = types.SimpleNamespace(previous_db_name=db_name, change_merge_rows=merge_rows, hash_algorithm="xxh3_128")
+    start = time.perf_counter()
+    changed = find_changed_files(store, range(len(store)), config, by="content")
+    return time.perf_counter() - start, len(store), len(changed)
+
+# Catalog insert and incremental join time with count rows of history: one execute() per row
+# into an unindexed table and the tracker join, against the catalog layer (WAL, pragmas, batched
+# writes, versioned tables with covering indexes) and the change detector.
+# "append" is the write at the end of a backup, one more run of 100000 rows.
+def bench_catalog(sizes):
+    from catalog import open_catalog
+    sizes = sizes or [1000000, 5000000, 10000000]
+    for count in sizes:
+        root = tempfile.mkdtemp(prefix="backup_bench_")
+        try:
+            for name in ("execute, no index", "catalog layer"):
+                db_name = os.path.join(root, name.split(",")[0].replace(" ", "_") + ".sqlite")
+                start = time.perf_counter()
+                if name == "catalog layer":
+                    conn = open_catalog(db_name)
+                    write_history(conn, count)
+                    load_time = time.perf_counter() - start
+                    start = time.perf_counter()
+                    write_history(conn, count + 100000, count)
+                else:
+                    conn = sqlite3.connect(db_name)
+                    conn.execute("CREATE TABLE backutil_previous(date TEXT, file TEXT, hash TEXT, mtime TEXT,size TEXT, ref TEXT, algo TEXT);")
+                    for row in catalog_history(count):
+                        conn.execute("INSERT INTO backutil_previous (date, file, hash, mtime, size, ref, algo) VALUES (?, ?, ?, ?, ?, ?, ?);", row)
+                    conn.commit()
+                    load_time = time.perf_counter() - start
+                    start = time.perf_counter()
+                    for row in catalog_history(count + 100000, count):
+                        conn.execute("INSERT INTO backutil_previous (date, file, hash, mtime, size, ref, algo) VALUES (?, ?, ?, ?, ?, ?, ?);", row)
+                    conn.commit()
+                append_time = time.perf_counter() - start
+                conn.close()
+                if name == "catalog layer":
+                    join_time, files, changed = detect_current_files(db_name, count, count * 10)
+                    merge_time, files, changed = detect_current_files(db_name, count, 0)
+                    print(f"{name:20} {count:>9} rows: load {load_time:7.1f}s, append {append_time:5.2f}s, "
+                          f"lookup of {files} files {join_time:6.2f}s, merge {merge_time:6.2f}s ({changed} changed)")
+                else:
+                    join_time, files, changed = join_current_files(db_name, count)
+                    print(f"{name:20} {count:>9} rows: load {load_time:7.1f}s, append {append_time:5.2f}s, "
+                          f"join of {files} files {join_time:6.2f}s ({changed} changed)")
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+# shutil.copy (the old staging copy) against every copy_engine mechanism, on the filesystem of
+# --path (default: the temp folder). Mechanisms the filesystem doesn't support are reported as such.
+def bench_copy(sizes, path=None):
+    import copy_engine
+    sizes = sizes or [5000]
+    for num_files in sizes:
+        root = tempfile.mkdtemp(prefix="backup_bench_", dir=path)
+        try:
+            store = make_test_tree(os.path.join(root, "src"), num_files, 4)
+            sources = [store.path(index) for index in range(len(store))]
+            candidates = [("shutil.copy", lambda src, dst: shutil.copy(src, dst)),
+                          ("copy_engine (auto)", lambda src, dst: copy_engine.copy_file(src, dst, 4 * 1024 * 1024))]
+            for name, _ in copy_engine.METHODS:
+                candidates.append((name, lambda src, dst, name=name: copy_engine.copy_file(src, dst, 4 * 1024 * 1024, methods=(name,))))
+            for name, copy in candidates:
+                destination = os.path.join(root, "dst")
+                targets = [os.path.join(destination, os.path.relpath(src, os.path.join(root, "src"))) for src in sources]
+                for target in targets:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                try:
+                    start = time.perf_counter()
+                    for src, dst in zip(sources, targets):
+                        copy(src, dst)
+                    # Count the time the data takes to reach the disk, not just the page cache
+                    os.sync() if hasattr(os, "sync") else None
+                    report(name, store, time.perf_counter() - start)
+                except OSError as err:
+                    print(f"{name:28} not supported here ({err})")
+                shutil.rmtree(destination, ignore_errors=True)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+# Session folder with compressible documents (text, 4-256 KB) and a few incompressible 64 MB files
+def make_document_tree(root, num_files, num_large=2):
+    store = FileRecordStore()
+    words = [f"word{i}".encode() for i in range(2000)]
+    random_block = os.urandom(1024 * 1024)
+    for i in range(num_files):
+        folder = os.path.join(root, f"docs{i // 500}")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"file{i}.txt")
+        size = 4096 << (i % 7)
+        with open(path, "wb") as f:
+            f.write(b" ".join(words[(i * 7 + n * 13) % len(words)] for n in range(size // 6))[:size])
+        stat = os.stat(path)
+        store.add("C:", path, stat.st_mtime, stat.st_size, stat.st_ino)
+    for i in range(num_large):
+        path = os.path.join(root, f"media{i}.mp4")
+        with open(path, "wb") as f:
+            for _ in range(64):
+                f.write(random_block)
+        stat = os.stat(path)
+        store.add("C:", path, stat.st_mtime, stat.st_size, stat.st_ino)
+    return store
+
+# The current single-threaded ZIP_STORED writer and a single-threaded ZIP_DEFLATED zipfile against
+# the parallel ZIP writer with 1, 2, 4 and all cores, then on all cores with zip_skip_incompressible
+def bench_zip(sizes):
+    import zipfile
+    from parallel_zip import create_parallel_zip_from_folder
+    sizes = sizes or [5000]
+    cores = os.cpu_count() or 1
+    for num_files in sizes:
+        root = tempfile.mkdtemp(prefix="backup_bench_")
+        try:
+            src_dir = os.path.join(root, "Full-20260101")
+            store = make_document_tree(src_dir, num_files)
+            archive_path = os.path.join(root, "bench.zip")
+
+            def zipfile_writer(compression):
+                def write():
+                    with zipfile.ZipFile(archive_path, mode='w', compression=compression) as zip_file:
+                        for index in range(len(store)):
+                            zip_file.write(store.path(index), arcname=os.path.relpath(store.path(index), src_dir))
+                return write
+
+            candidates = [("zipfile stored (current)", zipfile_writer(zipfile.ZIP_STORED)),
+                          ("zipfile deflate, 1 thread", zipfile_writer(zipfile.ZIP_DEFLATED))]
+            for workers in sorted({1, 2, 4, cores}):
+                config = bench_config(store, zip_compression_level=6, zip_workers=workers, zip_skip_incompressible=False)
+                candidates.append((f"parallel deflate, {workers} workers", lambda config=config: create_parallel_zip_from_folder(src_dir, archive_path, config)))
+            # The first run sniffs, the second decides from what the catalog learned
+            config = bench_config(store, zip_compression_level=6, zip_workers=cores, zip_skip_incompressible=True,
+                                  previous_db_name=os.path.join(root, "catalog.db"))
+            for run in ("sniffed", "learned"):
+                candidates.append((f"skip incompressible, {run}", lambda config=config: create_parallel_zip_from_folder(src_dir, archive_path, config)))
+            for name, write in candidates:
+                start = time.perf_counter()
+                write()
+                elapsed = time.perf_counter() - start
+                with zipfile.ZipFile(archive_path) as zip_file:
+                    assert len(zip_file.infolist()) == len(store)
+                report(name, store, elapsed)
+                print(f"{'':28} archive {os.path.getsize(archive_path) / 1048576:.0f} MB")
+                os.remove(archive_path)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+# The current single lz4.frame stream against the block-parallel writer with 1, 2, 4 and all
+# cores, for a few block sizes; every archive is read back through lz4.frame to check it
+def bench_lz4(sizes):
+    import tarfile
+    import lz4.frame
+    from parallel_lz4 import ParallelLZ4Writer
+    sizes = sizes or [5000]
+    cores = os.cpu_count() or 1
+    for num_files in sizes:
+        root = tempfile.mkdtemp(prefix="backup_bench_")
+        try:
+            src_dir = os.path.join(root, "Full-20260101")
+            store = make_document_tree(src_dir, num_files)
+            archive_path = os.path.join(root, "bench.tar.lz4")
+            candidates = [("lz4.frame stream (current)", lambda: lz4.frame.open(archive_path, mode='wb'))]
+            for block_size in (1024 * 1024, 8 * 1024 * 1024):
+                for workers in sorted({1, 2, 4, cores}):
+                    candidates.append((f"{block_size >> 20} MB blocks, {workers} workers",
+                                       lambda block_size=block_size, workers=workers: ParallelLZ4Writer(archive_path, block_size, workers)))
+            for name, open_archive in candidates:
+                start = time.perf_counter()
+                with open_archive() as lz4_file:
+                    with tarfile.open(fileobj=lz4_file, mode='w') as tar:
+                        tar.add(src_dir, arcname=os.path.basename(src_dir))
+                elapsed = time.perf_counter() - start
+                with lz4.frame.open(archive_path, mode='rb') as lz4_file:
+                    with tarfile.open(fileobj=lz4_file, mode='r|') as tar:
+                        assert sum(1 for info in tar if info.isfile()) == len(store)
+                report(name, store, elapsed)
+                print(f"{'':28} archive {os.path.getsize(archive_path) / 1048576:.0f} MB")
+                os.remove(archive_path)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+# Archive size and speed of the .tar.zst writer at a few levels, with and without a trained
+# dictionary, against the stored zip, the parallel zip and the block-parallel tar.lz4 on all cores
+def bench_zstd(sizes):
+    import tarfile
+    import zipfile
+    from parallel_zip import create_parallel_zip_from_folder
+    from parallel_lz4 import ParallelLZ4Writer
+    from zstd_archive import create_zstd_file_from_folder, open_zstd_archive
+    sizes = sizes or [5000]
+    for num_files in sizes:
+        root = tempfile.mkdtemp(prefix="backup_bench_")
+        try:
+            src_dir = os.path.join(root, "Full-20260101")
+            store = make_document_tree(src_dir, num_files)
+
+            def zip_stored(archive_path):
+                with zipfile.ZipFile(archive_path, mode='w') as zip_file:
+                    for index in range(len(store)):
+                        zip_file.write(store.path(index), arcname=os.path.relpath(store.path(index), src_dir))
+
+            def tar_lz4(archive_path):
+                with ParallelLZ4Writer(archive_path) as lz4_file:
+                    with tarfile.open(fileobj=lz4_file, mode='w') as tar:
+                        tar.add(src_dir, arcname=os.path.basename(src_dir))
+
+            candidates = [("zipfile stored", "bench.zip", zip_stored),
+                          ("parallel deflate 6", "bench.zip",
+                           lambda archive_path: create_parallel_zip_from_folder(src_dir, archive_path, bench_config(store, zip_compression_level=6, zip_workers=0, zip_skip_incompressible=False))),
+                          ("parallel lz4", "bench.tar.lz4", tar_lz4)]
+            for level in (3, 6, 12):
+                for dictionary in (False, True):
+                    config = bench_config(store, zstd_level=level, zstd_threads=0, zstd_dictionary=dictionary, zstd_dict_size=112640,
+                                          zstd_dict_samples=2000, previous_db_name=os.path.join(root, "catalog.db"))
+                    candidates.append((f"zstd {level}{' + dictionary' if dictionary else ''}", "bench.tar.zst",
+                                       lambda archive_path, config=config: create_zstd_file_from_folder(src_dir, archive_path, config)))
+            for name, archive_name, write in candidates:
+                archive_path = os.path.join(root, archive_name)
+                start = time.perf_counter()
+                write(archive_path)
+                elapsed = time.perf_counter() - start
+                if archive_name.endswith(".tar.zst"):
+                    with tarfile.open(fileobj=open_zstd_archive(archive_path), mode='r|') as tar:
+                        assert sum(1 for info in tar if info.isfile()) == len(store)
+                report(name, store, elapsed)
+                print(f"{'':28} archive {os.path.getsize(archive_path) / 1048576:.1f} MB "
+                      f"({os.path.getsize(archive_path) / store.total_size():.1%})")
+                os.remove(archive_path)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+# The ZipFile.testzip() check against verify_zip: quick (central directory and a sample of
+# members) and full (every member) with 1 and all cores
+def bench_verify(sizes):
+    import zipfile
+    from archive_verify import verify_zip, write_stored_member
+    sizes = sizes or [5000]
+    cores = os.cpu_count() or 1
+    for num_files in sizes:
+        root = tempfile.mkdtemp(prefix="backup_bench_")
+        try:
+            src_dir = os.path.join(root, "Full-20260101")
+            store = make_document_tree(src_dir, num_files)
+            archive_path = os.path.join(root, "bench.zip")
+            expected = {}
+            with zipfile.ZipFile(archive_path, mode='w') as zip_file:
+                for index in range(len(store)):
+                    info = zipfile.ZipInfo.from_file(store.path(index), arcname=os.path.relpath(store.path(index), src_dir))
+                    with open(store.path(index), 'rb') as f:
+                        expected[info.filename] = write_stored_member(zip_file, info, f, 1024 * 1024)
+
+            def testzip():
+                with zipfile.ZipFile(archive_path) as zip_file:
+                    assert zip_file.testzip() is None
+
+            candidates = [("testzip (current)", testzip)]
+            for mode, workers in [("quick", cores)] + [("full", workers) for workers in sorted({1, cores})]:
+                config = bench_config(store, archive_verify=mode, archive_verify_sample=32, archive_verify_workers=workers, hash_algorithm=None)
+                candidates.append((f"{mode}, {workers} readers", lambda config=config: verify_zip(archive_path, expected, config)))
+            for name, verify in candidates:
+                start = time.perf_counter()
+                assert verify() is not False
+                report(name, store, time.perf_counter() - start)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+BENCHMARKS = {
+    'record_store': bench_record_store,
+    'hashing': bench_hashing,
+    'hash_paths': bench_hash_paths,
+    'hash_algorithms': bench_hash_algorithms,
+    'catalog': bench_catalog,
+    'copy': bench_copy,
+    'zip': bench_zip,
+    'lz4': bench_lz4,
+    'zstd': bench_zstd,
+    'verify': bench_verify,
+}
+# Benchmarks that take --path
+PATH_BENCHMARKS = ('hash_algorithms', 'copy')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backup engine benchmarks")
+    parser.add_argument('name', choices=sorted(BENCHMARKS))
+    parser.add_argument('--sizes', type=int, nargs='+', help="number of synthetic files (default depends on the benchmark)")
+    parser.add_argument('--path', help="hash_algorithms: hash the files under this folder instead of a synthetic tree; "
+                        "copy: run on the filesystem of this folder")
+    args = parser.parse_args()
+    if args.path and args.name not in PATH_BENCHMARKS:
+        parser.error(f"--path only applies to {' and '.join(PATH_BENCHMARKS)}")
+    if args.path:
+        BENCHMARKS[args.name](args.sizes, args.path)
+    else:
+        BENCHMARKS[args.name](args.sizes)
@@ -0,0 +1,265 @@
+import os
+import sqlite3
+import tarfile
+import zipfile
+import lz4.frame
+
+# Catalog rows written before the algo column existed were hashed with xxh64
+LEGACY_HASH_ALGORITHM = "xxh64"
+
+# Schema version kept in PRAGMA user_version. 0 is the single backutil_previous table,
+# 2 added backutil_maintenance, 3 backutil_dictionaries, 4 backutil_compressibility.
+CATALOG_VERSION = 4
+
+# Rows per executemany() call when writing the catalog
+WRITE_BATCH = 50000
+
+# WAL lets readers (the incremental join) run while a backup writes, NORMAL is durable enough
+# with WAL, and a larger page cache keeps the indexes of a long history in memory.
+CATALOG_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA cache_size=-65536;",
+    "PRAGMA temp_store=MEMORY;",
+)
+
+# Version 1 schema:
+#   backutil_runs     one row per backup: date, full/incremental, archive file name, hash algorithm
+#   backutil_content  one row per distinct (hash, algo)
+#   backutil_files    every path a run recorded, with its content; duplicates carry ref, the path
+#                     their content was stored under
+#   backutil_members  where a run's archive holds a content: member name, byte offset, length
+#   backutil_maintenance  when housekeeping such as space reclamation last ran
+#   backutil_dictionaries the zstd dictionary a .tar.zst archive was compressed with
+#   backutil_compressibility  per file extension, the bytes the zip writer measured before and
+#                     after deflating, summed over the runs
+# backutil_previous stays as a view with the old columns, so the incremental queries keep working.
+# The files indexes cover the path comparison (file, mtime, size) and the content comparison
+# (content, mtime, size) of the change detector.
+CATALOG_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS backutil_runs(run_id INTEGER PRIMARY KEY, date TEXT, kind TEXT, archive TEXT, algo TEXT);",
+    "CREATE TABLE IF NOT EXISTS backutil_content(content_id INTEGER PRIMARY KEY, hash TEXT, algo TEXT, size INTEGER, UNIQUE(hash, algo));",
+    "CREATE TABLE IF NOT EXISTS backutil_files(run_id INTEGER, file TEXT, mtime TEXT, size TEXT, content_id INTEGER, ref TEXT);",
+    "CREATE TABLE IF NOT EXISTS backutil_members(run_id INTEGER, content_id INTEGER, member TEXT, offset INTEGER, length INTEGER, PRIMARY KEY(run_id, content_id));",
+    "CREATE TABLE IF NOT EXISTS backutil_maintenance(name TEXT PRIMARY KEY, value TEXT);",
+    "CREATE TABLE IF NOT EXISTS backutil_dictionaries(archive TEXT PRIMARY KEY, dict_id INTEGER, data BLOB);",
+    "CREATE TABLE IF NOT EXISTS backutil_compressibility(extension TEXT PRIMARY KEY, files INTEGER, bytes_in INTEGER, bytes_out INTEGER);",
+    "CREATE INDEX IF NOT EXISTS backutil_runs_date ON backutil_runs(date);",
+    "CREATE INDEX IF NOT EXISTS backutil_files_path ON backutil_files(file, mtime, size, run_id);",
+    "CREATE INDEX IF NOT EXISTS backutil_files_content ON backutil_files(content_id, mtime, size, run_id);",
+    "CREATE INDEX IF NOT EXISTS backutil_files_run ON backutil_files(run_id);",
+    "CREATE VIEW IF NOT EXISTS backutil_previous AS SELECT r.date AS date, f.file AS file, c.hash AS hash, f.mtime AS mtime, f.size AS size, f.ref AS ref, c.algo AS algo "
+    "FROM backutil_files f JOIN backutil_runs r ON r.run_id = f.run_id LEFT JOIN backutil_content c ON c.content_id = f.content_id;",
+)
+
+# Open the <computer>.sqlite catalog with the tuned pragmas, creating the current schema or
+# migrating an older catalog to it
+def open_catalog(db_name):
+    conn = sqlite3.connect(db_name)
+    if not conn.execute("SELECT 1 FROM sqlite_master;").fetchone():
+        # A new file: freed pages can be handed back with incremental_vacuum from the start.
+        # This has to happen before anything (even the WAL switch) writes the database header.
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+    for pragma in CATALOG_PRAGMAS:
+        conn.execute(pragma)
+    version = conn.execute("PRAGMA user_version;").fetchone()[0]
+    if version > CATALOG_VERSION:
+        conn.close()
+        raise sqlite3.DatabaseError(f"{db_name} has catalog version {version}, this version reads up to {CATALOG_VERSION}")
+    if version < CATALOG_VERSION:
+        _migrate(conn)
+    return conn
+
+# True when db_name holds a catalog with at least the table (or view) the queries read
+def has_catalog(db_name):
+    if not os.path.exists(db_name):
+        return False
+    conn = sqlite3.connect(db_name)
+    try:
+        return conn.execute("SELECT name FROM sqlite_master WHERE name = 'backutil_previous';").fetchone() is not None
+    finally:
+        conn.close()
+
+# Bring a catalog up to CATALOG_VERSION in one transaction. From version 0 every date in
+# backutil_previous becomes a run, every distinct hash a content row and every row a file of its
+# run; archive names and member offsets were never recorded for those runs and stay empty.
+# Later versions only add tables.
+def _migrate(conn):
+    legacy = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'backutil_previous';").fetchone()
+    if legacy:
+        upgrade_previous_table(conn)
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        for statement in CATALOG_SCHEMA[:-1]:
+            conn.execute(statement)
+        if legacy:
+            conn.execute("INSERT INTO backutil_runs (date, algo) SELECT date, MAX(algo) FROM backutil_previous GROUP BY date ORDER BY date;")
+            conn.execute("INSERT OR IGNORE INTO backutil_content (hash, algo, size) SELECT hash, algo, CAST(size AS INTEGER) FROM backutil_previous WHERE hash IS NOT NULL;")
+            conn.execute("INSERT INTO backutil_files (run_id, file, mtime, size, content_id, ref) "
+                         "SELECT r.run_id, p.file, p.mtime, p.size, c.content_id, p.ref FROM backutil_previous p "
+                         "JOIN backutil_runs r ON r.date = p.date LEFT JOIN backutil_content c ON c.hash = p.hash AND c.algo = p.algo;")
+            conn.execute("DROP TABLE backutil_previous;")
+        conn.execute(CATALOG_SCHEMA[-1])
+        conn.execute(f"PRAGMA user_version = {CATALOG_VERSION};")
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+# Add the columns older backutil_previous tables are missing. Rows from before the algo column
+# were hashed with xxh64.
+def upgrade_previous_table(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(backutil_previous);")]
+    with conn:
+        for column in ("file", "ref", "algo"):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE backutil_previous ADD COLUMN {column} TEXT;")
+        if "algo" not in columns:
+            conn.execute("UPDATE backutil_previous SET algo = ?;", (LEGACY_HASH_ALGORITHM,))
+
+# Record one backup run. files yields (file, hash, mtime, size, ref, member key) where the member
+# key is the file's path inside the session folder for stored files and None for duplicates;
+# members maps member keys to (member name, offset, length) as read_archive_members returns them.
+# Rows go in with executemany in batches, all in the transaction that adds the run, so a run that
+# fails part way is rolled back whole and find_file_at, the change detector and retention never
+# see it half written.
+# Returns the number of files recorded.
+def write_run(conn, date, kind, archive, algorithm, files, members, batch_size=WRITE_BATCH):
+    conn.execute("BEGIN IMMEDIATE;")
+    try:
+        run_id = conn.execute("INSERT INTO backutil_runs (date, kind, archive, algo) VALUES (?, ?, ?, ?);",
+                              (date, kind, archive, algorithm)).lastrowid
+        written = 0
+        batch = []
+        for row in files:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                written += _write_batch(conn, run_id, algorithm, batch, members)
+                batch = []
+        if batch:
+            written += _write_batch(conn, run_id, algorithm, batch, members)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return written
+
+def _write_batch(conn, run_id, algorithm, batch, members):
+    conn.executemany("INSERT OR IGNORE INTO backutil_content (hash, algo, size) VALUES (?, ?, ?);",
+                     ((file_hash, algorithm, size) for file, file_hash, mtime, size, ref, key in batch))
+    conn.executemany("INSERT INTO backutil_files (run_id, file, mtime, size, content_id, ref) "
+                     "VALUES (?, ?, ?, ?, (SELECT content_id FROM backutil_content WHERE hash = ? AND algo = ?), ?);",
+                     ((run_id, file, mtime, size, file_hash, algorithm, ref) for file, file_hash, mtime, size, ref, key in batch))
+    conn.executemany("INSERT OR REPLACE INTO backutil_members (run_id, content_id, member, offset, length) "
+                     "VALUES (?, (SELECT content_id FROM backutil_content WHERE hash = ? AND algo = ?), ?, ?, ?);",
+                     ((run_id, file_hash, algorithm) + members[key]
+                      for file, file_hash, mtime, size, ref, key in batch if key in members))
+    return len(batch)
+
+# Delete every run recorded under one of dates, with its files and members, and the content no
+# run refers to any more. Returns the number of runs deleted.
+def delete_run_dates(conn, dates):
+    dates = list(dates)
+    if not dates:
+        return 0
+    placeholders = ", ".join("?" * len(dates))
+    with conn:
+        run_ids = [row[0] for row in conn.execute(f"SELECT run_id FROM backutil_runs WHERE date IN ({placeholders});", dates)]
+        if run_ids:
+            run_list = ", ".join(str(run_id) for run_id in run_ids)
+            conn.execute(f"DELETE FROM backutil_files WHERE run_id IN ({run_list});")
+            conn.execute(f"DELETE FROM backutil_members WHERE run_id IN ({run_list});")
+            conn.execute(f"DELETE FROM backutil_runs WHERE run_id IN ({run_list});")
+            conn.execute("DELETE FROM backutil_content WHERE NOT EXISTS (SELECT 1 FROM backutil_files f WHERE f.content_id = backutil_content.content_id);")
+            conn.execute("DELETE FROM backutil_dictionaries WHERE archive NOT IN (SELECT archive FROM backutil_runs WHERE archive IS NOT NULL);")
+    return len(run_ids)
+
+def write_dictionary(conn, archive, dict_id, data):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO backutil_dictionaries (archive, dict_id, data) VALUES (?, ?, ?);", (archive, dict_id, data))
+
+# The zstd dictionary of an archive as bytes, None when it was compressed without one
+def read_dictionary(conn, archive):
+    row = conn.execute("SELECT data FROM backutil_dictionaries WHERE archive = ?;", (archive,)).fetchone()
+    return row[0] if row else None
+
+# {extension: (files, bytes in, bytes out)} measured by earlier runs
+def read_compressibility(conn):
+    return {extension: (files, bytes_in, bytes_out)
+            for extension, files, bytes_in, bytes_out in conn.execute("SELECT extension, files, bytes_in, bytes_out FROM backutil_compressibility;")}
+
+# Add one run's measurements, {extension: (files, bytes in, bytes out)}, to the totals
+def add_compressibility(conn, outcomes):
+    with conn:
+        conn.executemany("INSERT INTO backutil_compressibility (extension, files, bytes_in, bytes_out) VALUES (?, ?, ?, ?) "
+                         "ON CONFLICT(extension) DO UPDATE SET files = files + excluded.files, "
+                         "bytes_in = bytes_in + excluded.bytes_in, bytes_out = bytes_out + excluded.bytes_out;",
+                         ((extension,) + totals for extension, totals in outcomes.items()))
+
+# Hand the pages freed by deletes back to the file system. A catalog created before incremental
+# auto-vacuum was switched on needs one full VACUUM to convert; after that incremental_vacuum
+# only moves the free pages. The WAL is checkpointed and truncated as well.
+def reclaim_catalog_space(conn):
+    conn.commit()
+    if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        conn.execute("VACUUM;")
+    else:
+        conn.execute("PRAGMA incremental_vacuum;").fetchall()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+
+def get_maintenance(conn, name):
+    row = conn.execute("SELECT value FROM backutil_maintenance WHERE name = ?;", (name,)).fetchone()
+    return row[0] if row else None
+
+def set_maintenance(conn, name, value):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO backutil_maintenance (name, value) VALUES (?, ?);", (name, value))
+
+# Size of the catalog on disk, database and WAL file
+def catalog_file_size(db_name):
+    return sum(os.path.getsize(path) for path in (db_name, db_name + "-wal") if os.path.exists(path))
+
+# Rows of file history, for sizing decisions (cheap, from the rowid)
+def catalog_row_count(conn):
+    return conn.execute("SELECT MAX(rowid) FROM backutil_files;").fetchone()[0] or 0
+
+# Where a path was as of date (YYYYMMDD): (run date, archive, member, offset, length, hash) from
+# the newest run up to that date that recorded the path, or None. Members of migrated runs are
+# unknown (None).
+def find_file_at(conn, file, date):
+    return conn.execute(
+        "SELECT r.date, r.archive, m.member, m.offset, m.length, c.hash FROM backutil_files f "
+        "JOIN backutil_runs r ON r.run_id = f.run_id "
+        "LEFT JOIN backutil_content c ON c.content_id = f.content_id "
+        "LEFT JOIN backutil_members m ON m.run_id = f.run_id AND m.content_id = f.content_id "
+        "WHERE f.file = ? AND r.date <= ? ORDER BY r.date DESC, r.run_id DESC LIMIT 1;", (file, date)).fetchone()
+
+# Members of a finished archive as {path inside the session folder: (member name, offset, length)},
+# the path with / separators. For zip the offset is the local header's position in the file and
+# the length the compressed size. A .tar.lz4 or .tar.zst is one compressed stream, so there the
+# offset is the member data's position in the tar stream and the length its size.
+def read_archive_members(archive_path):
+    members = {}
+    if archive_path.endswith('.zip'):
+        with zipfile.ZipFile(archive_path) as zip_file:
+            for info in zip_file.infolist():
+                members[info.filename] = (info.filename, info.header_offset, info.compress_size)
+    elif archive_path.endswith('.tar.lz4') or archive_path.endswith('.tar.zst'):
+        with open_tar_stream(archive_path) as stream:
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                for info in tar:
+                    if info.isfile():
+                        members[tar_member_key(info)] = (info.name, info.offset_data, info.size)
+    return members
+
+# Decompressed tar stream of a .tar.lz4 or .tar.zst
+def open_tar_stream(archive_path):
+    if archive_path.endswith('.tar.zst'):
+        from zstd_archive import open_zstd_archive
+        return open_zstd_archive(archive_path)
+    return lz4.frame.open(archive_path, mode='rb')
+
+# Members sit under the session folder name, the key is the path below it
+def tar_member_key(info):
+    return info.name.split('/', 1)[1] if '/' in info.name else info.name
@@ -0,0 +1,126 @@
+import os
+import math
+import time
+import heapq
+import pickle
+import sqlite3
+import tempfile
+from array import array
+from submain import log
+from catalog import open_catalog, has_catalog, catalog_row_count
+
+# Scan records sorted in memory at a time by the merge detector before a run is spilled to disk
+MERGE_CHUNK = 500000
+# Records per pickle.dump() in a spilled run, the unit read back during the merge
+SPILL_BATCH = 10000
+
+# Streaming change detection against the backutil_previous catalog, without copying the scan
+# into the tracker DB first. by="file" compares (path, mtime, size) like the path join of
+# main_incremental_change.py, by="content" compares (hash, mtime, size, algo) like main.py.
+# Up to change_merge_rows rows of history every scanned file is looked up through the catalog indexes;
+# beyond that the scan is sorted in bounded runs on disk and merged with the catalog read in
+# index order, so neither side is held in memory.
+# Returns the record indices of the changed files. Raises sqlite3.OperationalError
+# ("no such table") when there is no catalog yet.
+def find_changed_files(store, indices, config, by="file"):
+    start = time.perf_counter()
+    if not has_catalog(config.previous_db_name):
+        raise sqlite3.OperationalError("no such table: backutil_previous")
+    conn = open_catalog(config.previous_db_name)
+    try:
+        history_rows = catalog_row_count(conn)
+        if history_rows > config.change_merge_rows:
+            mode = "merge"
+            changed = array('I', _merge_changed(store, indices, conn, by, config.hash_algorithm))
+        else:
+            mode = "lookup"
+            changed = array('I', _lookup_changed(store, indices, conn, by, config.hash_algorithm))
+    finally:
+        conn.close()
+    log(f"Change detection ({mode}, by {by}, {history_rows} catalog rows): {len(changed)} changed files "
+        f"in {time.perf_counter() - start:.1f}s.", "Success")
+    return changed
+
+# One indexed query per scanned file. The parameters get the columns' TEXT affinity, so mtime
+# and size compare exactly as they did in the tracker join.
+def _lookup_changed(store, indices, conn, by, algorithm):
+    if by == "file":
+        query = "SELECT 1 FROM backutil_previous WHERE file = ? AND mtime = ? AND size = ? LIMIT 1;"
+        params = lambda index: (store.path(index), store.mtimes[index], store.sizes[index])
+    else:
+        query = "SELECT 1 FROM backutil_previous WHERE hash = ? AND mtime = ? AND size = ? AND algo = ? LIMIT 1;"
+        params = lambda index: (store.hashes[index], store.mtimes[index], store.sizes[index], algorithm)
+    for index in indices:
+        if conn.execute(query, params(index)).fetchone() is None:
+            yield index
+
+def _merge_changed(store, indices, conn, by, algorithm):
+    if by == "file":
+        key_of = store.path
+        catalog = conn.execute("SELECT file, mtime, size, NULL FROM backutil_files ORDER BY file;")
+    else:
+        key_of = store.hashes.__getitem__
+        # Content in (hash, algo) index order, each with its files from the content index
+        catalog = conn.execute("SELECT c.hash, f.mtime, f.size, c.algo FROM backutil_content c "
+                               "JOIN backutil_files f ON f.content_id = c.content_id ORDER BY c.hash;")
+    row = next(catalog, None)
+    group_key = None
+    group = []
+    for key, index in _sorted_scan(indices, key_of):
+        if key != group_key:
+            # SQLite orders TEXT by its UTF-8 bytes, the same order as Python's str comparison
+            while row is not None and (row[0] is None or row[0] < key):
+                row = next(catalog, None)
+            group_key = key
+            group = []
+            while row is not None and row[0] == key:
+                group.append(row[1:])
+                row = next(catalog, None)
+        if not any(_same_file(store, index, mtime, size, algo, by, algorithm) for mtime, size, algo in group):
+            yield index
+
+# The catalog keeps mtime as SQLite's 15 significant digit text form of the float
+def _same_file(store, index, mtime, size, algo, by, algorithm):
+    if by == "content" and algo != algorithm:
+        return False
+    try:
+        return int(size) == store.sizes[index] and math.isclose(float(mtime), store.mtimes[index], rel_tol=1e-14)
+    except (TypeError, ValueError):
+        return False
+
+# (key, index) pairs in key order, sorted in runs of MERGE_CHUNK that are spilled to a temporary
+# folder and merged back, so memory stays bounded by one run
+def _sorted_scan(indices, key_of):
+    with tempfile.TemporaryDirectory(prefix="backutil_changes_") as spill_dir:
+        runs = []
+        chunk = []
+        for index in indices:
+            chunk.append((key_of(index), index))
+            if len(chunk) >= MERGE_CHUNK:
+                runs.append(_spill(spill_dir, len(runs), chunk))
+                chunk = []
+        if not runs:
+            chunk.sort()
+            yield from chunk
+            return
+        if chunk:
+            runs.append(_spill(spill_dir, len(runs), chunk))
+        del chunk
+        yield from heapq.merge(*(_read_run(path) for path in runs))
+
+def _spill(spill_dir, number, chunk):
+    chunk.sort()
+    path = os.path.join(spill_dir, f"run{number}.pickle")
+    with open(path, "wb") as f:
+        for offset in range(0, len(chunk), SPILL_BATCH):
+            pickle.dump(chunk[offset:offset + SPILL_BATCH], f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+def _read_run(path):
+    with open(path, "rb") as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
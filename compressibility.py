@@ -0,0 +1,87 @@
+import os
+import zlib
+from catalog import open_catalog, read_compressibility, add_compressibility
+
+# Per-file compression decisions for the zip writer. Content that is already compressed (media,
+# Office/ZIP containers, archives) is stored instead of being deflated for no gain: known
+# extensions are stored outright, others are sniffed by deflating a sample of their first block
+# at level 1, and the ratios measured for each extension are kept in the catalog so that after
+# a few runs the extension alone decides.
+
+COMPRESS = "compress"
+STORE = "store"
+SNIFF = "sniff"
+
+# Extensions of formats that are compressed already
+STORED_EXTENSIONS = frozenset((
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".avif",
+    ".mp4", ".m4v", ".mov", ".mkv", ".avi", ".wmv", ".webm",
+    ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac", ".wma",
+    ".zip", ".7z", ".rar", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".cab", ".jar", ".apk",
+    ".docx", ".xlsx", ".pptx", ".docm", ".xlsm", ".pptm", ".odt", ".ods", ".odp", ".epub", ".pdf",
+    ".msi", ".iso",
+))
+# Bytes of the first block deflated to sniff a file
+SNIFF_SIZE = 64 * 1024
+# A sample or an extension has to shrink below this share of its size to be worth deflating
+WORTH_RATIO = 0.95
+# Files of an extension measured before the catalog's ratio replaces sniffing
+LEARNED_FILES = 20
+
+def extension(path):
+    return os.path.splitext(path)[1].lower()
+
+# (sample size, deflated size) of the first block of a file
+def sniff(block):
+    sample = block[:SNIFF_SIZE]
+    return len(sample), len(zlib.compress(sample, 1))
+
+def worth_compressing(bytes_in, bytes_out):
+    return bytes_out < bytes_in * WORTH_RATIO
+
+class CompressionPolicy:
+    def __init__(self, learned=None):
+        # {extension: (files, bytes in, bytes out)} from earlier runs, and what this run measured
+        self.learned = learned or {}
+        self.outcomes = {}
+        self.decisions = {COMPRESS: 0, STORE: 0, SNIFF: 0}
+
+    def decide(self, path):
+        ext = extension(path)
+        files, bytes_in, bytes_out = self.learned.get(ext, (0, 0, 0))
+        if files >= LEARNED_FILES and bytes_in:
+            decision = COMPRESS if worth_compressing(bytes_in, bytes_out) else STORE
+        elif ext in STORED_EXTENSIONS:
+            decision = STORE
+        else:
+            decision = SNIFF
+        self.decisions[decision] += 1
+        return decision
+
+    # measured is (bytes in, bytes out) of the sample or the whole file, None when it was
+    # stored without being measured
+    def record(self, path, measured):
+        if measured is None or not measured[0]:
+            return
+        files, bytes_in, bytes_out = self.outcomes.get(extension(path), (0, 0, 0))
+        self.outcomes[extension(path)] = (files + 1, bytes_in + measured[0], bytes_out + measured[1])
+
+    def summary(self):
+        return ", ".join(f"{count} {decision}" for decision, count in self.decisions.items())
+
+# The policy with what the catalog learned in earlier runs
+def load_policy(config):
+    conn = open_catalog(config.previous_db_name)
+    try:
+        return CompressionPolicy(read_compressibility(conn))
+    finally:
+        conn.close()
+
+def save_policy(config, policy):
+    if not policy.outcomes:
+        return
+    conn = open_catalog(config.previous_db_name)
+    try:
+        add_compressibility(conn, policy.outcomes)
+    finally:
+        conn.close()
@@ -0,0 +1,193 @@
+import io
+import os
+import sys
+import errno
+import struct
+import shutil
+import threading
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+    import pywintypes
+    import win32file
+except ImportError:
+    win32file = None
+
+# Copy engine: copies a file with the fastest mechanism that works for the two files and falls back
+# to the next one. On Windows: block_clone (FSCTL_DUPLICATE_EXTENTS_TO_FILE, the copy shares the
+# source's clusters on ReFS), then CopyFileEx (the system copy, offloaded to the server on SMB shares
+# and to the storage with ODX). On Linux: reflink (a clone sharing the source's blocks, Btrfs/XFS),
+# copy_file_range (in-kernel copy, server-side on NFS/SMB mounts), sendfile. Everywhere, last:
+# readinto with a reused buffer.
+
+# FICLONE ioctl from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# Bytes per copy_file_range()/sendfile() call
+KERNEL_CHUNK = 1024 * 1024 * 1024
+DEFAULT_BUFFER = 8 * 1024 * 1024
+# Errors meaning the mechanism can't copy between these two files, not that the copy failed
+_UNSUPPORTED = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOTTY}
+
+# winioctl.h
+FSCTL_DUPLICATE_EXTENTS_TO_FILE = 0x00098344
+FSCTL_SET_SPARSE = 0x000900C4
+FILE_ATTRIBUTE_SPARSE_FILE = 0x200
+# Bytes per FSCTL_DUPLICATE_EXTENTS_TO_FILE call, a multiple of every cluster size (it has to stay below 4 GB)
+CLONE_CHUNK = 1024 * 1024 * 1024
+# CopyFileEx copies files from this size on without going through the file cache
+COPY_FILE_NO_BUFFERING = 0x1000
+UNBUFFERED_COPY_SIZE = 256 * 1024 * 1024
+# Windows errors meaning the mechanism can't copy between these two files: ERROR_INVALID_FUNCTION,
+# ERROR_NOT_SAME_DEVICE, ERROR_NOT_SUPPORTED, ERROR_INVALID_PARAMETER, ERROR_BLOCK_TOO_MANY_REFERENCES
+_UNSUPPORTED_WINERRORS = {1, 17, 50, 87, 347}
+# Other Windows errors as the OSError subclasses the callers catch
+_WINERRORS = {2: errno.ENOENT, 3: errno.ENOENT, 5: errno.EACCES, 32: errno.EACCES, 112: errno.ENOSPC}
+
+def _win_error(err, path):
+    if err.winerror in _UNSUPPORTED_WINERRORS:
+        code = errno.ENOTSUP
+    else:
+        code = _WINERRORS.get(err.winerror, errno.EIO)
+    return OSError(code, f"{err.funcname}: {err.strerror}", path)
+
+def _block_clone(src, dst, buffer_size):
+    sectors_per_cluster, bytes_per_sector = win32file.GetDiskFreeSpace(os.path.splitdrive(os.path.abspath(dst))[0] + "\\")[:2]
+    cluster = sectors_per_cluster * bytes_per_sector
+    stat = os.stat(src)
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        dst_handle = msvcrt.get_osfhandle(fdst.fileno())
+        try:
+            if getattr(stat, "st_file_attributes", 0) & FILE_ATTRIBUTE_SPARSE_FILE:
+                # A sparse source can only be cloned into a sparse file
+                win32file.DeviceIoControl(dst_handle, FSCTL_SET_SPARSE, None, None)
+            # The clone goes into the file's existing range, so it gets its final size first
+            fdst.truncate(stat.st_size)
+            src_handle = msvcrt.get_osfhandle(fsrc.fileno())
+            offset = 0
+            while offset < stat.st_size:
+                # Whole clusters: the last one may reach past the end of the file
+                count = min(-(-(stat.st_size - offset) // cluster) * cluster, CLONE_CHUNK)
+                win32file.DeviceIoControl(dst_handle, FSCTL_DUPLICATE_EXTENTS_TO_FILE,
+                                          struct.pack("Pqqq", src_handle, offset, offset, count), None)
+                offset += count
+        except pywintypes.error as err:
+            raise _win_error(err, src) from None
+
+def _copy_file_ex(src, dst, buffer_size):
+    flags = COPY_FILE_NO_BUFFERING if os.path.getsize(src) >= UNBUFFERED_COPY_SIZE else 0
+    try:
+        win32file.CopyFileEx(src, dst, None, None, False, flags)
+    except pywintypes.error as err:
+        raise _win_error(err, src) from None
+
+def _reflink(src_fd, dst_fd, buffer_size):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+def _copy_file_range(src_fd, dst_fd, buffer_size):
+    while os.copy_file_range(src_fd, dst_fd, KERNEL_CHUNK):
+        pass
+
+def _sendfile(src_fd, dst_fd, buffer_size):
+    offset = 0
+    while True:
+        sent = os.sendfile(dst_fd, src_fd, offset, KERNEL_CHUNK)
+        if not sent:
+            return
+        offset += sent
+
+_buffers = threading.local()
+
+def _buffer(buffer_size):
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) != buffer_size:
+        buffer = _buffers.buffer = bytearray(buffer_size)
+    return buffer
+
+def _readinto(src_fd, dst_fd, buffer_size):
+    view = memoryview(_buffer(buffer_size))
+    src_file = io.FileIO(src_fd, closefd=False)
+    while True:
+        read = src_file.readinto(view)
+        if not read:
+            return
+        written = 0
+        while written < read:
+            written += os.write(dst_fd, view[written:read])
+
+# (name, function): the Windows functions work on the two paths, the others on open descriptors
+METHODS = []
+if win32file is not None:
+    METHODS.append(("block_clone", _block_clone))
+    METHODS.append(("copyfileex", _copy_file_ex))
+_BY_PATH = {"block_clone", "copyfileex"}
+if fcntl is not None and sys.platform.startswith("linux"):
+    METHODS.append(("reflink", _reflink))
+if hasattr(os, "copy_file_range"):
+    METHODS.append(("copy_file_range", _copy_file_range))
+if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+    # Only Linux can sendfile() into a regular file
+    METHODS.append(("sendfile", _sendfile))
+METHODS.append(("readinto", _readinto))
+
+# Mechanisms that already failed between two devices, so they aren't tried again for every file
+_unsupported = {}
+_counts_lock = threading.Lock()
+_counts = {}
+
+# Copy the data of src to dst like shutil.copyfile, and the permission bits like shutil.copy when
+# copy_mode is set. methods limits the mechanisms tried (the benchmark uses it).
+# Returns the name of the mechanism that did the copy.
+def copy_file(src, dst, buffer_size=DEFAULT_BUFFER, copy_mode=True, methods=None):
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+    skip = _unsupported.get(devices, ())
+    for name, method in METHODS:
+        if name in skip or (methods is not None and name not in methods):
+            continue
+        try:
+            if name in _BY_PATH:
+                method(src, dst, buffer_size)
+            else:
+                _copy_descriptors(method, src, dst, buffer_size)
+            break
+        except OSError as err:
+            if err.errno not in _UNSUPPORTED or name == "readinto":
+                raise
+            # Start over with the next mechanism, which truncates dst again
+            _unsupported.setdefault(devices, set()).add(name)
+    else:
+        raise OSError(errno.ENOTSUP, f"No copy method left for {src}")
+    if copy_mode:
+        shutil.copymode(src, dst)
+    with _counts_lock:
+        _counts[name] = _counts.get(name, 0) + 1
+    return name
+
+def _copy_descriptors(method, src, dst, buffer_size):
+    flags = getattr(os, "O_BINARY", 0)
+    src_fd = os.open(src, os.O_RDONLY | flags)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | flags, 0o666)
+        try:
+            method(src_fd, dst_fd, buffer_size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+# Copy src into an already open file object, e.g. an smbclient file on a share
+def copy_to_fileobj(src, dst_file, buffer_size=DEFAULT_BUFFER):
+    view = memoryview(_buffer(buffer_size))
+    with open(src, 'rb') as src_file:
+        while True:
+            read = src_file.readinto(view)
+            if not read:
+                return
+            dst_file.write(view[:read])
+
+# Files copied per mechanism so far
+def method_counts():
+    with _counts_lock:
+        return dict(_counts)
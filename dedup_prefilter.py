@@ -0,0 +1,65 @@
+import xxhash
+import concurrent.futures
+from submain import log
+
+# Bytes read from the start and from the end of a file for its partial hash
+PARTIAL_BLOCK = 64 * 1024
+
+# Hash of the first and last PARTIAL_BLOCK bytes, enough to tell most same-size files apart
+def partial_hash(file_path, size):
+    partial = xxhash.xxh64()
+    with open(file_path, "rb") as f:
+        partial.update(f.read(PARTIAL_BLOCK))
+        if size > PARTIAL_BLOCK:
+            f.seek(max(size - PARTIAL_BLOCK, PARTIAL_BLOCK))
+            partial.update(f.read(PARTIAL_BLOCK))
+    return partial.hexdigest()
+
+# Split the files that still need a hash into duplicate candidates and files that cannot have a
+# duplicate in this backup. Files are grouped by size, same-size files by a partial hash, and only
+# files that still collide (or share their size with a file whose hash is already known) are
+# candidates; they need their full hash before the copy. The rest are hashed while they are copied.
+# Returns (candidates, unique).
+def find_duplicate_candidates(store, indices, known, config):
+    sizes = store.sizes
+    by_size = {}
+    for index in indices:
+        by_size.setdefault(sizes[index], []).append(index)
+    known_sizes = {sizes[index] for index in known}
+
+    candidates = []
+    unique = []
+    to_sample = []
+    for size, group in by_size.items():
+        if size in known_sizes:
+            candidates.extend(group)
+        elif len(group) == 1:
+            unique.extend(group)
+        else:
+            to_sample.extend(group)
+    num_unique_size = len(unique)
+
+    by_partial = {}
+    bytes_sampled = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.max_threads) as executor:
+        futures = {executor.submit(partial_hash, store.path(index), sizes[index]): index for index in to_sample}
+        for future in concurrent.futures.as_completed(futures):
+            index = futures[future]
+            bytes_sampled += min(sizes[index], 2 * PARTIAL_BLOCK)
+            try:
+                key = (sizes[index], future.result())
+            except Exception:
+                # Let the copy report the error
+                unique.append(index)
+                continue
+            by_partial.setdefault(key, []).append(index)
+    for group in by_partial.values():
+        if len(group) == 1:
+            unique.extend(group)
+        else:
+            candidates.extend(group)
+
+    saved = max(store.total_size(unique) - bytes_sampled, 0)
+    log(f"Dedup prefilter: {num_unique_size} files with a unique size, {len(unique) - num_unique_size} more told apart "
+        f"by a partial hash, {len(candidates)} files fully hashed before copying; saved {saved / 1048576:.0f} MB of reading.", "Success")
+    return candidates, unique
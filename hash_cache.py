@@ -0,0 +1,75 @@
+import sqlite3
+import xxhash
+from datetime import datetime
+from submain import log, LEGACY_HASH_ALGORITHM
+
+# Persistent hash cache, kept in the <computer>.sqlite catalog.
+# A file whose path, size, mtime and file ID (where the scan had one) match the cached row
+# reuses the stored hash instead of being read again. Rows expire after max_age_days, so every
+# file still gets re-read now and then. In paranoid mode a rotating slice of the cached files
+# (paranoid_percent per run) is hashed anyway and compared with the cache to catch silent corruption.
+# Rows hashed with another algorithm than the current one count as misses.
+class HashCache:
+    def __init__(self, db_name, max_age_days=90, paranoid_percent=0, algorithm=LEGACY_HASH_ALGORITHM):
+        self.conn = sqlite3.connect(db_name)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS backutil_hash_cache(file TEXT PRIMARY KEY, size INTEGER, mtime REAL, file_id INTEGER, hash TEXT, checked TEXT, algo TEXT);")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(backutil_hash_cache);")]
+        if "algo" not in columns:
+            with self.conn:
+                self.conn.execute("ALTER TABLE backutil_hash_cache ADD COLUMN algo TEXT;")
+                self.conn.execute("UPDATE backutil_hash_cache SET algo = ?;", (LEGACY_HASH_ALGORITHM,))
+        self.algorithm = algorithm
+        self.today = datetime.now()
+        self.cutoff = datetime.fromordinal(self.today.toordinal() - max_age_days).strftime("%Y%m%d")
+        self.buckets = round(100 / paranoid_percent) if paranoid_percent > 0 else 0
+        self.bucket = self.today.toordinal() % self.buckets if self.buckets else 0
+        self.expected = {}
+        self.pending = []
+        self.hits = 0
+        self.sampled = 0
+        self.mismatches = 0
+
+    # Return the cached hash of a store record, or None if the file has to be read
+    def lookup(self, store, index):
+        file_path = store.path(index)
+        row = self.conn.execute("SELECT size, mtime, file_id, hash, checked, algo FROM backutil_hash_cache WHERE file = ?;", (file_path,)).fetchone()
+        if row is None:
+            return None
+        size, mtime, file_id, file_hash, checked, algo = row
+        if size != store.sizes[index] or mtime != store.mtimes[index] or checked < self.cutoff or algo != self.algorithm:
+            return None
+        if file_id and store.file_ids[index] and file_id != store.file_ids[index]:
+            return None
+        if self.buckets and xxhash.xxh32_intdigest(file_path.encode("utf-8", "surrogatepass")) % self.buckets == self.bucket:
+            # Paranoid sample: hash it again and compare in store()
+            self.expected[file_path] = file_hash
+            self.sampled += 1
+            return None
+        self.hits += 1
+        return file_hash
+
+    # Remember a freshly computed hash, written to the catalog by close()
+    def store(self, store, index, file_hash):
+        file_path = store.path(index)
+        expected = self.expected.pop(file_path, None)
+        if expected is not None and expected != file_hash:
+            self.mismatches += 1
+            log(f"Warning: {file_path} changed content without a new size or mtime (possible silent corruption).", "Warning")
+        self.pending.append((file_path, store.sizes[index], store.mtimes[index], store.file_ids[index], file_hash, self.today.strftime("%Y%m%d"), self.algorithm))
+
+    def close(self):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO backutil_hash_cache (file, size, mtime, file_id, hash, checked, algo) VALUES (?, ?, ?, ?, ?, ?, ?);", self.pending)
+            self.conn.execute("DELETE FROM backutil_hash_cache WHERE checked < ?;", (self.cutoff,))
+        self.conn.close()
+        self.pending = []
+        log(f"Hash cache reused {self.hits} hashes.", "Success")
+        if self.buckets:
+            log(f"Paranoid check re-read {self.sampled} cached files, {self.mismatches} did not match.", "Success")
+
+def open_hash_cache(config):
+    try:
+        return HashCache(config.previous_db_name, config.hash_cache_max_age, config.paranoid_sample_percent, config.hash_algorithm)
+    except sqlite3.Error as err:
+        log(f"Error opening hash cache, hashing every file: {err}", "Warning")
+        return None
@@ -0,0 +1,119 @@
+import time
+import concurrent.futures
+from submain import log, hash_file, DEFAULT_HASH_ALGORITHM
+
+# Small files are grouped into one task until a batch holds this many files or bytes
+BATCH_FILES = 256
+BATCH_BYTES = 16 * 1024 * 1024
+# How often the tuner compares throughput and moves the number of tasks in flight
+TUNE_INTERVAL = 2.0
+
+# Hash a batch of small files in one task; module level so a process pool can run it.
+# Returns one (hash, error message) pair per path.
+def hash_file_batch(paths, buffer_size, mmap_threshold=0, algorithm=DEFAULT_HASH_ALGORITHM):
+    results = []
+    for path in paths:
+        try:
+            results.append((hash_file(path, buffer_size, mmap_threshold, algorithm), None))
+        except Exception as exc:
+            results.append((None, str(exc)))
+    return results
+
+# Hill-climbing controller for the number of hashing tasks in flight.
+# Every TUNE_INTERVAL seconds it scores the last interval (MB/s plus files/s, a file open
+# counted as 64 KB of reading), keeps moving the limit in the same direction while the score
+# improves and turns around when it drops.
+class ThroughputTuner:
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.limit = max(1, max_workers // 2)
+        self.step = 1
+        self.last_score = None
+        self.interval_start = time.perf_counter()
+        self.interval_bytes = 0
+        self.interval_files = 0
+
+    def record(self, num_bytes, num_files):
+        self.interval_bytes += num_bytes
+        self.interval_files += num_files
+        now = time.perf_counter()
+        elapsed = now - self.interval_start
+        if elapsed < TUNE_INTERVAL:
+            return
+        score = (self.interval_bytes + self.interval_files * 65536) / elapsed
+        if self.last_score is not None and score < self.last_score * 0.95:
+            self.step = -self.step
+        self.limit = min(self.max_workers, max(1, self.limit + self.step))
+        self.last_score = score
+        self.interval_start = now
+        self.interval_bytes = 0
+        self.interval_files = 0
+
+# Adaptive hashing engine, yields (index, hash, error) like hash_files_per_thread.
+# Files up to small_file_limit are hashed in batches (in a process pool when hash_processes > 0,
+# which takes the per-file Python work off the GIL), larger files get a thread task each so the
+# reads of several big files overlap. The number of tasks in flight follows the ThroughputTuner.
+def hash_files_adaptive(store, indices, config):
+    start = time.perf_counter()
+    large_files = []
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for index in indices:
+        size = store.sizes[index]
+        if size > config.small_file_limit:
+            large_files.append(index)
+            continue
+        batch.append(index)
+        batch_bytes += size
+        if len(batch) >= BATCH_FILES or batch_bytes >= BATCH_BYTES:
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+    if batch:
+        batches.append(batch)
+    # Biggest files first so a multi-GB file does not start last and run alone
+    large_files.sort(key=lambda index: store.sizes[index], reverse=True)
+
+    max_workers = config.max_threads * 2
+    tuner = ThroughputTuner(max_workers)
+    thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=config.hash_processes) if config.hash_processes > 0 else None
+    batch_pool = process_pool or thread_pool
+    tasks = [(thread_pool, [index]) for index in large_files] + [(batch_pool, batch) for batch in batches]
+    pending = {}
+    total_bytes = 0
+    total_files = 0
+    try:
+        for pool, task_indices in tasks:
+            while len(pending) >= tuner.limit:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    done_indices = pending.pop(future)
+                    yield from _task_results(future, done_indices)
+                    done_bytes = store.total_size(done_indices)
+                    total_bytes += done_bytes
+                    total_files += len(done_indices)
+                    tuner.record(done_bytes, len(done_indices))
+            future = pool.submit(hash_file_batch, [store.path(index) for index in task_indices], config.buffer_size, config.mmap_threshold, config.hash_algorithm)
+            pending[future] = task_indices
+        for future in concurrent.futures.as_completed(list(pending)):
+            done_indices = pending.pop(future)
+            yield from _task_results(future, done_indices)
+            total_bytes += store.total_size(done_indices)
+            total_files += len(done_indices)
+    finally:
+        thread_pool.shutdown(cancel_futures=True)
+        if process_pool is not None:
+            process_pool.shutdown(cancel_futures=True)
+    elapsed = max(time.perf_counter() - start, 0.001)
+    log(f"Hash engine: {total_files} files, {total_bytes / 1048576:.0f} MB in {elapsed:.1f}s "
+        f"({total_bytes / 1048576 / elapsed:.1f} MB/s, {total_files / elapsed:.0f} files/s), "
+        f"{tuner.limit} tasks in flight at the end.", "Success")
+
+def _task_results(future, task_indices):
+    try:
+        results = future.result()
+    except Exception as exc:
+        return [(index, None, exc) for index in task_indices]
+    return [(index, file_hash, error) for index, (file_hash, error) in zip(task_indices, results)]
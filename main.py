@@ -18,6 +18,16 @@ from datetime import datetime
 import pyuac
 from submain import *
 from vss_snapshot import *
+from pipeline import run_streaming_backup, iter_tracker_backed_up_items
+from change_detector import find_changed_files
+from retention import delete_old_backups
+from archive_writer import write_archive_direct
+from parallel_zip import create_parallel_zip_from_folder
+from parallel_lz4 import ParallelLZ4Writer
+from zstd_archive import create_zstd_file_from_folder
+from archive_verify import verify_zip, write_stored_member
+from record_store import FileRecordStore
+from array import array
 #from net_share import shared_folder_backup
 #from net_share2 import shared_folder_backup,file_filter,is_server_online
 #from net_share3 import shared_folder_backup,file_filter,is_server_online
@@ -51,13 +61,44 @@ class Config:
         self.tracker_db_conn = ""
         self.tracker_db_name = ":memory:"
         self.tracker_db_cursor = ""
-        self.backup_files = {}
+        self.backup_files = FileRecordStore()
         self.num_folders  = 0
         self.total_size = 0
-        self.files_to_back_up = []
+        self.files_to_back_up = array('I')
         self.snapshot_ids = {}
         self.key = b'IBcc4gScWlZZLj-NRrzWz_bbzHDq_ZcI-VO4DHdBdxk='
         self.force_full_backup = False
+        self.scan_workers = 2 * max_threads
+        self.exclude_specs = []
+        self.streaming_pipeline = False
+        self.pipeline_queue_size = 1024
+        self.hash_cache = True
+        self.hash_cache_max_age = 90
+        self.paranoid_sample_percent = 1
+        self.hash_engine = "adaptive"
+        self.hash_processes = 0
+        self.small_file_limit = 1048576
+        self.mmap_threshold = 67108864
+        self.fused_copy_hash = True
+        self.size_prefilter = True
+        self.hash_algorithm = DEFAULT_HASH_ALGORITHM
+        self.change_merge_rows = 20000000
+        self.catalog_vacuum_days = 7
+        self.direct_archive = False
+        self.zip_compression_level = 6
+        self.zip_workers = 0
+        self.zip_skip_incompressible = True
+        self.lz4_workers = 0
+        self.lz4_block_size = 4194304
+        self.archive_format = 'auto'
+        self.zstd_level = 3
+        self.zstd_threads = 0
+        self.zstd_dictionary = False
+        self.zstd_dict_size = 112640
+        self.zstd_dict_samples = 2000
+        self.archive_verify = 'quick'
+        self.archive_verify_sample = 32
+        self.archive_verify_workers = 0
 
 # check the last date of backup
 def get_last_backup_date(backup_dir):
@@ -66,7 +107,7 @@ def get_last_backup_date(backup_dir):
     inc_dates = []
     for filename in os.listdir(backup_dir):
         # Filter out directories and get only the files
-        if os.path.isfile(os.path.join(backup_dir, filename)) and filename.endswith('.zip') or filename.endswith('.tar.lz4'):
+        if os.path.isfile(os.path.join(backup_dir, filename)) and filename.endswith('.zip') or filename.endswith('.tar.lz4') or filename.endswith('.tar.zst'):
             name, _ = os.path.splitext(filename)
             name, _ = os.path.splitext(name)
             if name.startswith('Full-'):
@@ -120,31 +161,8 @@ def determine_backup_type(directory_to_backup, last_full_backup, last_incrementa
             backup_type = None
     log(f"Determining backup type is {backup_type}... Done", "Success")
     return backup_type
-# If backups require rotation, ignore oldest hash file
-def get_changed_files_since_last_backup(config):
-    log("Getting changed files since last backup...", "Attempt")
-    snapshot_ids = Full_backup(config)
-    # JOINs previous hashes DB and tracker DB to find files to back up
-    try:
-        query_data = (config.previous_db_name,)
-        config.tracker_db_cursor.execute("ATTACH ? as backutil_previous", query_data)
-        results = config.tracker_db_cursor.execute(
-            "SELECT backutil_tracker.drive, backutil_tracker.file, backutil_tracker.hash, backutil_tracker.mtime,backutil_tracker.size, backutil_previous.date FROM backutil_tracker LEFT JOIN backutil_previous ON backutil_tracker.hash=backutil_previous.hash AND backutil_tracker.mtime = backutil_previous.mtime AND backutil_tracker.size = backutil_previous.size;")
-    except sqlite3.OperationalError as err:
-                if "no such table" in str(err) or "no such file or directory" in str(err):
-                    log("Database error: Database file missing or corrupt. Initiating full backup.", "Warning")
-                    config.force_full_backup = True  # Flag to trigger full backup
-                    return config.files_to_back_up , snapshot_ids, config.force_full_backup
-    if results:
-        for line in results:
-            # deepcode ignore change_to_is: <please specify a reason of ignoring this>
-            if line[5] == None:
-                config.files_to_back_up.append(line)
-    else:
-        log("there is no files to backup.", "Success")
-    return config.files_to_back_up , snapshot_ids ,config.force_full_backup
-
-def Full_backup(config):
+# Read the backup list and group the backup paths by volume
+def get_backup_volumes(config):
     backup_list = read_objects_to_backup_from_file(config)
     # Group the backup paths by volume
     if len(backup_list)==0:
@@ -158,10 +176,48 @@ def Full_backup(config):
             volumes[volume].append(path)
         else:
             volumes[volume] = [path]
+    return volumes
+
+# If backups require rotation, ignore oldest hash file
+def get_changed_files_since_last_backup(config):
+    log("Getting changed files since last backup...", "Attempt")
+    snapshot_ids = Full_backup(config)
+    # Looks up the hashed files in the previous backups DB to find files to back up
+    try:
+        hashed_files = (line[0] for line in config.tracker_db_conn.execute("SELECT idx FROM backutil_tracker WHERE dup_of IS NULL;"))
+        config.files_to_back_up.extend(find_changed_files(config.backup_files, hashed_files, config, by="content"))
+    except sqlite3.OperationalError as err:
+                if "no such table" in str(err) or "no such file or directory" in str(err):
+                    log("Database error: Database file missing or corrupt. Initiating full backup.", "Warning")
+                    config.force_full_backup = True  # Flag to trigger full backup
+                    return config.files_to_back_up , snapshot_ids, config.force_full_backup
+    if len(config.files_to_back_up) == 0:
+        log("there is no files to backup.", "Success")
+    return config.files_to_back_up , snapshot_ids ,config.force_full_backup
+
+def Full_backup(config, hash_files=True):
+    volumes = get_backup_volumes(config)
     # Create VSS snapshots for each volume
     config.snapshot_ids = vss_create(volumes)
     get_all_files_to_backup(volumes,config.snapshot_ids,config)
-    split_and_generate_hashes(config.backup_files,config)
+    if hash_files:
+        split_and_generate_hashes(range(len(config.backup_files)),config)
+    return config.snapshot_ids
+
+# Full backup in streaming mode, files are hashed and copied to the session folder while the scan runs
+def Full_backup_streaming(config, backup_filename):
+    volumes = get_backup_volumes(config)
+    # Create VSS snapshots for each volume
+    config.snapshot_ids = vss_create(volumes)
+    backup_dir = config.directory_to_backup
+    backup_folder = os.path.splitext(backup_filename)[0]
+    config.temp_folder_path = os.path.join(backup_dir, backup_folder)
+    try:
+        os.makedirs(config.temp_folder_path)
+    except:
+        log("Error creating session folder (or already exists).", "Warning")
+    records = iter_files_to_backup(volumes, config.snapshot_ids, config)
+    run_streaming_backup(records, backup_dir, backup_folder, config)
     return config.snapshot_ids
 
 # Main routine - gathers files, adds to Zip, copies to backup directory
@@ -170,6 +226,8 @@ def main_backup(config):
     last_full_backup, last_incremental_backup = get_last_backup_date(config.directory_to_backup)
     backup_type = determine_backup_type(config.directory_to_backup, last_full_backup, last_incremental_backup,
                                         config.retention_policy)
+    streamed = False
+    fused = False
     if backup_type is None:
         # no backup needed, exit program
         log("No backup needed.", "INFORMA")
@@ -188,21 +246,32 @@ def main_backup(config):
     elif backup_type == "full":
         # perform full backup
         backup_filename = "Full-" + today.strftime("%Y%m%d") + ".zip"
-        snapshot_ids = Full_backup(config)
-        results = config.tracker_db_cursor.execute("SELECT drive,file,hash,mtime,size,'None' AS date FROM backutil_tracker;")
-        for line in results:
-            config.files_to_back_up.append(line)
-        get_total(config)
+        if config.streaming_pipeline:
+            snapshot_ids = Full_backup_streaming(config, backup_filename)
+            streamed = True
+        elif config.fused_copy_hash:
+            # Files are hashed while they are copied to the session folder
+            snapshot_ids = Full_backup(config, hash_files=False)
+            config.files_to_back_up.extend(range(len(config.backup_files)))
+            fused = True
+            get_total(config)
+        else:
+            snapshot_ids = Full_backup(config)
+            results = config.tracker_db_cursor.execute("SELECT idx FROM backutil_tracker WHERE dup_of IS NULL;")
+            for line in results:
+                config.files_to_back_up.append(line[0])
+            get_total(config)
     elif backup_type == "incremental":
         # perform incremental backup
         backup_filename = "Incremental-" + today.strftime("%Y%m%d") + ".zip"
+        use_catalog_hash_algorithm(config)
         changed_files , snapshot_ids, config.force_full_backup = get_changed_files_since_last_backup(config)
         if config.force_full_backup:
             # perform full backup
             backup_filename = "Full-" + today.strftime("%Y%m%d") + ".zip"
-            results = config.tracker_db_cursor.execute("SELECT drive,file,hash,mtime,size,'None' AS date FROM backutil_tracker;")
+            results = config.tracker_db_cursor.execute("SELECT idx FROM backutil_tracker WHERE dup_of IS NULL;")
             for line in results:
-                config.files_to_back_up.append(line)
+                config.files_to_back_up.append(line[0])
                 
         elif changed_files is None or len(changed_files) == 0:
             log("No backup needed.", "INFORMA")
@@ -222,11 +291,18 @@ def main_backup(config):
             log("Finished.", "Success")
             sys.exit()
         get_total(config)
+    # direct_archive writes the snapshot files straight into the archive, so only the archive needs
+    # room; otherwise the staging folder and the archive made from it are on the drive together
+    # (a streamed backup has already copied its files, only the archive is left to write)
+    direct = config.direct_archive and not streamed
+    space_needed = config.total_size if direct or streamed else 2 * config.total_size
      # Create staging folder and copy files, make list
-    if check_free_space(config.directory_to_backup, config.total_size):
+    if check_free_space(config.directory_to_backup, space_needed):
         pass
     else:
         log("There is not enough free space on the backup drive","Warning")
+        if streamed:
+            delete_temp(config)
         for snapshotid in config.snapshot_ids.values():
                 delete_vss_snapshot(snapshotid)
         if config.shared_folder == "True":
@@ -247,40 +323,65 @@ def main_backup(config):
     backup_folder = os.path.splitext(backup_filename)[0]
     temp_folder_path = os.path.join(backup_dir, backup_folder)
     config.temp_folder_path = temp_folder_path
-    try:
-        os.makedirs(temp_folder_path)
-    except:
-        log("Error creating session folder (or already exists).", "Warning")
-    log("Backup and session folders created successfully.", "Success")
-    log("Copying files to session folder...", "Attempt")
-    # Split files to be backed up and copy in several subprocesses
-    start_time_copy = datetime.now()
-    split_files_to_back_up = (config.files_to_back_up[i::config.max_threads] for i in range(config.max_threads))
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=config.max_threads) as executor:
-        futures = [executor.submit(copy_files_pool, i+1, files_to_back_up_thread, backup_dir, backup_folder, config)
-                   for i, files_to_back_up_thread in enumerate(split_files_to_back_up)]
-        
-        # Combine the results from all threads
-        combined_dict = {}
-        for future in futures:
-            return_dict_thread = future.result()
-            for key, value in return_dict_thread.items():
-                combined_dict[key] = value
+    members = None
+    # This run's stored content {hash: details}, None when every first copy in the tracker was stored
+    stored = None
+    if streamed:
+        backed_up_items = iter_tracker_backed_up_items(config)
+    elif direct:
+        archive_format = choose_archive_format(config, temp_folder_path, config.total_size)
+        archive_path = temp_folder_path + ('.zip' if archive_format == 'zip' else archive_format)
+        create_status, combined_dict, members = write_archive_direct(config.files_to_back_up, archive_path, archive_format,
+                                                                     backup_folder, config, hash_files=fused)
+        stored = combined_dict
+        backed_up_items = combined_dict.items()
+    else:
+        try:
+            os.makedirs(temp_folder_path)
+        except:
+            log("Error creating session folder (or already exists).", "Warning")
+        log("Backup and session folders created successfully.", "Success")
+        log("Copying files to session folder...", "Attempt")
+        # Split files to be backed up and copy in several subprocesses
+        start_time_copy = datetime.now()
+        if fused:
+            combined_dict = copy_and_hash_files(config.files_to_back_up, backup_dir, backup_folder, config)
+        else:
+            work_queue = CopyWorkQueue(config.backup_files, config.files_to_back_up)
+            layout = StagingLayout(temp_folder_path)
+            layout.prepare(config.backup_files, config.files_to_back_up)
 
-    log("Files copied to session folder successfully.", "Success")
-    end_time_copy = datetime.now()
-    duration_copy = end_time_copy - start_time_copy
-    duration_str = str(duration_copy).split('.')[0]  # Remove the fractional seconds
-    log('Files copied Duration: '+ duration_str , "Success")
-    log("Creating archive file...", "Attempt")
-    archive_format = choose_archive_format_based_on_cpu_cores_and_size(temp_folder_path)
-    archive_path = os.path.join(backup_dir, os.path.basename(temp_folder_path))
-    if archive_format == 'zip':
-        archive_path += '.zip'
-    elif archive_format == '.tar.lz4':
-        archive_path += '.tar.lz4'
-    create_status = create_archive_from_folder(temp_folder_path, archive_path, archive_format,config)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=config.max_threads) as executor:
+                futures = [executor.submit(copy_files_pool, i+1, work_queue, layout, config)
+                           for i in range(config.max_threads)]
+
+                # Combine the results from all threads
+                combined_dict = {}
+                for future in futures:
+                    return_dict_thread = future.result()
+                    for key, value in return_dict_thread.items():
+                        combined_dict[key] = value
+            work_queue.report()
+        stored = combined_dict
+        backed_up_items = combined_dict.items()
+
+        log("Files copied to session folder successfully.", "Success")
+        end_time_copy = datetime.now()
+        duration_copy = end_time_copy - start_time_copy
+        duration_str = str(duration_copy).split('.')[0]  # Remove the fractional seconds
+        log('Files copied Duration: '+ duration_str , "Success")
+    if not direct:
+        write_duplicates_manifest(config, temp_folder_path, stored)
+        log("Creating archive file...", "Attempt")
+        archive_format = choose_archive_format(config, temp_folder_path)
+        archive_path = os.path.join(backup_dir, os.path.basename(temp_folder_path))
+        if archive_format == 'zip':
+            archive_path += '.zip'
+        elif archive_format == '.tar.lz4':
+            archive_path += '.tar.lz4'
+        elif archive_format == '.tar.zst':
+            archive_path += '.tar.zst'
+        create_status = create_archive_from_folder(temp_folder_path, archive_path, archive_format,config)
     
     # Delete VSS snapshots
     for volume, snapshot_id in snapshot_ids.items():
@@ -289,43 +390,32 @@ def main_backup(config):
     # Write backed up hashes to DB
         log("Writing hashes to DB...", "Attempt")
         try:
-            manage_previous_db(config, "open")
-            for key, value in combined_dict.items():
-                #drive = config.backup_files[key]['drive']
-                mtime = value['mtime']
-                size = value['size']
-                query_data = (config.backup_time, key,mtime,size)
-                config.previous_db_cursor.execute("INSERT INTO backutil_previous (date, hash, mtime, size) VALUES (?, ?, ?, ?);", query_data)
-            config.previous_db_conn.commit()
-            manage_previous_db(config, "close")
+            write_backup_to_catalog(config, backed_up_items, archive_path, backup_filename.split("-")[0].lower(), members, stored)
             log("Hashes written to DB successfully.", "Success")
         except:
             log("Error writing hashes to DB.", "Warning")
 
 # create zip from temp folder
-def create_zip_file_from_folder(src_dir, archive_path,retries=3, retry_delay=10):
+def create_zip_file_from_folder(src_dir, archive_path, config, retries=3, retry_delay=10):
     start_time_zip = datetime.now()
     log("Creating zip file from folder: " + src_dir, "Attempt")
     object_to_backup_path = Path(src_dir)
     for i in range(retries):
         try:
             zip_file = zipfile.ZipFile(archive_path, mode='w')
+            # CRC and size of every member computed from the data read, for the archive check
+            expected = {}
             if object_to_backup_path.is_file():
                 # If the object to write is a file, write the file
-                zip_file.write(object_to_backup_path.absolute(), arcname=object_to_backup_path.name,
-                            compress_type=zipfile.ZIP_STORED, )
-            elif object_to_backup_path.is_dir():
-                # If the object to write is a directory, write all the files
-                for file in object_to_backup_path.glob('**/*'):
-                    if file.is_file():
-                        zip_file.write(
-                            file.absolute(),
-                            arcname=str(file.relative_to(object_to_backup_path)),
-                            compress_type=zipfile.ZIP_STORED
-                        )
-                    elif file.is_dir() and not any(file.iterdir()):
-                        # If the directory is empty, skip it
-                        continue
+                files = [(object_to_backup_path, object_to_backup_path.name)]
+            else:
+                # If the object to write is a directory, write all the files (empty directories are skipped)
+                files = [(file, str(file.relative_to(object_to_backup_path)))
+                         for file in object_to_backup_path.glob('**/*') if file.is_file()]
+            for file, arcname in files:
+                info = zipfile.ZipInfo.from_file(file.absolute(), arcname=arcname)
+                with open(file.absolute(), 'rb') as f:
+                    expected[info.filename] = write_stored_member(zip_file, info, f, config.buffer_size)
             # Close the created zip file
             zip_file.close()
             log("zip file created successfully.", "Success")
@@ -333,11 +423,8 @@ def create_zip_file_from_folder(src_dir, archive_path,retries=3, retry_delay=10)
             duration_zip = end_time_zip - start_time_zip
             duration_str = str(duration_zip).split('.')[0]  # Remove the fractional seconds
             log('zip archive Duration: ' + duration_str, "Success")
-            # Check the validity of the zip file
-            if is_zip_valid(archive_path):
-                return True
-            else:
-                return False
+            # Check the zip file against what was written
+            return verify_zip(archive_path, expected, config)
         except Exception as e:
             log("Process terminate : {}".format(e), "Failure")
             log(f"Error encountered during zip file creation: {str(e)}", "Error")
@@ -349,12 +436,6 @@ def create_zip_file_from_folder(src_dir, archive_path,retries=3, retry_delay=10)
                 log(f"Zip file creation failed ({e}).", "Failure")
                 return False
     return False
-def is_zip_valid(filepath):
-    try:
-        with ZipFile(filepath) as zipfile:
-            return zipfile.testzip() is None
-    except Exception:
-        return False
 
 def create_lz4_file_from_folder(src_dir, archive_path,config ,retries=3, retry_delay=10):
     start_time_zip = datetime.now()
@@ -362,7 +443,8 @@ def create_lz4_file_from_folder(src_dir, archive_path,config ,retries=3, retry_d
     object_to_backup_path = Path(src_dir)
     for i in range(retries):
         try:
-            with lz4.frame.open(archive_path, mode='wb') as lz4_file:
+            # Blocks of the tar stream are compressed by lz4_workers threads
+            with ParallelLZ4Writer(archive_path, config.lz4_block_size, config.lz4_workers) as lz4_file:
                 with tarfile.open(fileobj=lz4_file, mode='w') as tar:
                     tar.add(src_dir, arcname=object_to_backup_path.name)
 
@@ -391,12 +473,17 @@ def create_lz4_file_from_folder(src_dir, archive_path,config ,retries=3, retry_d
     return False
         
 def create_archive_from_folder(src_dir, archive_path, archive_format,config):
-    if archive_format == 'zip':
-        status = create_zip_file_from_folder(src_dir, archive_path)
+    if archive_format == 'zip' and config.zip_compression_level > 0:
+        # Deflated by worker processes, verified like create_zip_file_from_folder verifies its archive
+        return create_parallel_zip_from_folder(src_dir, archive_path, config, on_disk_full=free_up_space)
+    elif archive_format == 'zip':
+        status = create_zip_file_from_folder(src_dir, archive_path, config)
         return status
     elif archive_format == '.tar.lz4':
         status = create_lz4_file_from_folder(src_dir, archive_path,config)
         return status
+    elif archive_format == '.tar.zst':
+        return create_zstd_file_from_folder(src_dir, archive_path, config)
     else:
         raise ValueError(f"Unsupported archive format: {archive_format}")
 
@@ -475,9 +562,11 @@ def move_backup_file(file, source_dir, destination_dir):
     shutil.move(source_path, destination_path)
     log(f'Moved backup file {file} to: {destination_dir}', "Success")
 
-def choose_archive_format_based_on_cpu_cores_and_size(folder_path):
+# folder_size is passed when the files aren't in a staging folder (direct_archive)
+def choose_archive_format_based_on_cpu_cores_and_size(folder_path, folder_size=None):
     cpu_cores = os.cpu_count()
-    folder_size = get_folder_size(folder_path)
+    if folder_size is None:
+        folder_size = get_folder_size(folder_path)
     folder_size_gb = folder_size / (1024 * 1024 * 1024)
 
     if cpu_cores is None or folder_size_gb <= 2:
@@ -487,6 +576,12 @@ def choose_archive_format_based_on_cpu_cores_and_size(folder_path):
     else:
         return 'zip'
 
+# archive_format from config.ini, or chosen from the backup size when it is auto
+def choose_archive_format(config, folder_path, folder_size=None):
+    if config.archive_format != 'auto':
+        return config.archive_format
+    return choose_archive_format_based_on_cpu_cores_and_size(folder_path, folder_size)
+
 # Deletes temporary files
 def delete_temp(config):
     # Delete folder on client machine
@@ -500,49 +595,6 @@ def delete_temp(config):
         pass
     log("Temporary files deleted successfully.", "Success")
 
-def delete_old_backups(backup_directory, delete_retention_policy,config):
-    log("Deleting previous backups in line with rotation configuration...", "Attempt")
-    full_backups_to_keep = delete_retention_policy[1]
-    incremental_backups_to_keep = delete_retention_policy[0]
-    backup_files = os.listdir(backup_directory)
-    full_backups = []
-    incremental_backups = []
-    # Separate the backup files into full and incremental backups
-    for backup_file in backup_files:
-        if backup_file.startswith('Full-'):
-            full_backups.append(backup_file)
-        elif backup_file.startswith('Incremental-'):
-            incremental_backups.append(backup_file)
-    # Sort the backup files by date
-    full_backups.sort(key=lambda x: datetime.strptime(re.search(r'\d{8}', x).group(), '%Y%m%d'), reverse=True)
-    incremental_backups.sort(key=lambda x: datetime.strptime(re.search(r'\d{8}', x).group(), '%Y%m%d'),
-                             reverse=True)
-    # Delete old full backups
-    for i in range(full_backups_to_keep, len(full_backups)):
-        backup_file = full_backups[i]
-        backup_path = os.path.join(backup_directory, backup_file)
-        del_prev_hashes(backup_file,config)
-        os.remove(backup_path)
-        log(f'Deleted old full backup: {backup_file}', "Success")
-    # Delete old incremental backups
-    for i in range(incremental_backups_to_keep, len(incremental_backups)):
-        backup_file = incremental_backups[i]
-        backup_path = os.path.join(backup_directory, backup_file)
-        del_prev_hashes(backup_file,config)
-        os.remove(backup_path)
-        log(f'Deleted old incremental backup: {backup_file}', "Success")
-
-def del_prev_hashes(filename,config):
-    manage_previous_db(config, "open")
-    datefilename = re.search(r'\d{8}', filename).group(0)
-   
-    query_data = (str(datefilename),)
-    config.previous_db_cursor.execute("DELETE FROM backutil_previous WHERE date = ?;", query_data)
-    config.previous_db_conn.commit()
-    log(f"{len(datefilename)} old backup hashes deleted.", "Success")
-    
-    # Close DB
-    manage_previous_db(config, "close")
 def get_current_user_name():
     session_id = win32ts.WTSGetActiveConsoleSessionId()
     user_name = win32ts.WTSQuerySessionInformation(
@@ -580,6 +632,7 @@ def main():
             update_config_file('config.ini','BACKUP','buffer_size',str(buffer_size))
         config = Config(computer_name, user_name, source_directory, directory_to_backup, retention_policy, int(max_threads),
                         int(buffer_size),delete_retention_policy,server_directory,server_ip,shared_folder,domain_name,server_pass)
+        load_tuning_options(config, config_file)
         if not server_pass:
             pass
         else:
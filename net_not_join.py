@@ -2,15 +2,11 @@ import os
 import threading
 from smbclient import register_session, listdir, open_file
 from submain import log
+from copy_engine import copy_to_fileobj
 
 def buffered_copy_smb(src, dst, buffer_size):
-    with open(src, 'rb') as src_file:
-        with open_file(dst, mode='wb') as dst_file:
-            while True:
-                chunk = src_file.read(buffer_size)
-                if not chunk:
-                    break
-                dst_file.write(chunk)
+    with open_file(dst, mode='wb') as dst_file:
+        copy_to_fileobj(src, dst_file, buffer_size)
 
 def copy_file(file, source_folder, destination_folder, config):
     source_path = os.path.join(source_folder, file)
@@ -20,8 +16,8 @@ def copy_file(file, source_folder, destination_folder, config):
 
 def compare_and_copy_zip_files(source_folder, destination_folder, config):
     log(f"Compare and copy zip files from {source_folder} to {destination_folder}...", "Attempt")
-    source_files = [f for f in os.listdir(source_folder) if os.path.isfile(os.path.join(source_folder, f)) and f.endswith('.zip') or f.endswith('.tar.lz4')]
-    destination_files = [f for f in listdir(destination_folder) if f.endswith('.zip') or f.endswith('.tar.lz4')]
+    source_files = [f for f in os.listdir(source_folder) if os.path.isfile(os.path.join(source_folder, f)) and f.endswith('.zip') or f.endswith('.tar.lz4') or f.endswith('.tar.zst')]
+    destination_files = [f for f in listdir(destination_folder) if f.endswith('.zip') or f.endswith('.tar.lz4') or f.endswith('.tar.zst')]
 
     threads = []
     for file in source_files:
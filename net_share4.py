@@ -7,6 +7,7 @@ from aiofiles import open as aio_open
 import subprocess
 import sys
 from submain import log
+from copy_engine import copy_file
 import socket
 from smbclient import register_session, listdir, open_file
 from smbclient.path import isdir
@@ -42,8 +43,8 @@ def set_permission_for_root_folder(folder, user_name):
 
 
 def file_filter(folder):
-    """Filter for .zip and .tar.lz4 files."""
-    return {f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)) and (f.endswith('.zip') or f.endswith('.tar.lz4'))}
+    """Filter for .zip, .tar.lz4 and .tar.zst files."""
+    return {f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)) and (f.endswith('.zip') or f.endswith('.tar.lz4') or f.endswith('.tar.zst'))}
 async def copy_file_with_shutil_with_retries(file, source_folder, destination_folder, queue, buffer_size=8388608, max_retries=3,retry_delay=10):
     source_path = os.path.join(source_folder, file)
     destination_path = os.path.join(destination_folder, file)
@@ -51,8 +52,7 @@ async def copy_file_with_shutil_with_retries(file, source_folder, destination_fo
     retries = 0
     while retries < max_retries:
         try:
-            with open(source_path, 'rb') as src_file, open(destination_path, 'wb') as dst_file:
-                shutil.copyfileobj(src_file, dst_file, length=buffer_size)
+            copy_file(source_path, destination_path, buffer_size, copy_mode=False)
             #shutil.copyfileobj(open(source_path, 'rb'), open(destination_path, 'wb'), length=buffer_size)
             log(f"File {file} copied successfully.", "Success")
             await queue.put(True)  # Signal success
@@ -72,7 +72,7 @@ async def copy_file_with_shutil(file, source_folder, destination_folder, queue,
     destination_path = os.path.join(destination_folder, file)
 
     try:
-        shutil.copyfileobj(open(source_path, 'rb'), open(destination_path, 'wb'), length=buffer_size)
+        copy_file(source_path, destination_path, buffer_size, copy_mode=False)
         log(f"File {file} copied successfully.", "Success")
         await queue.put(True)  # Signal success
     except Exception as e:
@@ -0,0 +1,78 @@
+import os
+import collections
+import concurrent.futures
+import lz4.frame
+
+# Block-parallel LZ4 writer: the stream written to it (the tar stream of a .tar.lz4 archive) is cut
+# into blocks of block_size that a thread pool compresses into independent LZ4 frames, written out
+# in order. lz4.frame releases the GIL while it compresses, so the threads use every core.
+# Concatenated frames are a valid LZ4 file: `lz4 -d` and lz4.frame.open() read them as one stream.
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+# Blocks compressed ahead of the writer per worker
+WINDOW_PER_WORKER = 2
+
+class ParallelLZ4Writer:
+    def __init__(self, archive_path, block_size=DEFAULT_BLOCK_SIZE, workers=0, compression_level=0):
+        self.block_size = block_size or DEFAULT_BLOCK_SIZE
+        self.workers = workers or os.cpu_count() or 1
+        self.compression_level = compression_level
+        self.file = open(archive_path, 'wb')
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = collections.deque()
+        self.chunks = []
+        self.buffered = 0
+        # Uncompressed bytes written so far, tarfile uses it as the stream offset
+        self.position = 0
+        self.bytes_out = 0
+        self.frames = 0
+
+    # Blocks are at least block_size: the writes are gathered and joined once, not cut to size
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.buffered += len(data)
+        self.position += len(data)
+        if self.buffered >= self.block_size:
+            self._submit(b"".join(self.chunks))
+            self.chunks = []
+            self.buffered = 0
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def _submit(self, block):
+        while len(self.pending) >= self.workers * WINDOW_PER_WORKER:
+            self._write_frame(self.pending.popleft())
+        self.pending.append(self.executor.submit(lz4.frame.compress, block, compression_level=self.compression_level))
+
+    def _write_frame(self, future):
+        frame = future.result()
+        self.file.write(frame)
+        self.bytes_out += len(frame)
+        self.frames += 1
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            # An empty stream still gets one (empty) frame so the file is a valid LZ4 file
+            if self.chunks or self.frames + len(self.pending) == 0:
+                self._submit(b"".join(self.chunks))
+                self.chunks = []
+            while self.pending:
+                self._write_frame(self.pending.popleft())
+        finally:
+            self.executor.shutdown(wait=True)
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # The stream is abandoned, its remaining frames are dropped
+            self.executor.shutdown(wait=True)
+            self.file.close()
@@ -0,0 +1,320 @@
+import os
+import io
+import time
+import errno
+import traceback
+import zlib
+import struct
+import shutil
+import tempfile
+import collections
+import concurrent.futures
+from datetime import datetime
+from submain import log, new_hash
+from compressibility import COMPRESS, STORE, SNIFF, sniff, worth_compressing, load_policy, save_policy
+from archive_verify import verify_zip
+
+# Parallel ZIP writer: worker processes deflate members independently (with their CRC-32, and the
+# content hash when asked), one writer appends them in order with their local headers and ends
+# the archive with the central directory, in ZIP64 form when it is needed. The result is a plain
+# deflate/stored ZIP that every unzip tool and the zipfile module read.
+# With a CompressionPolicy, already compressed files are stored without being deflated.
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+# Sizes and offsets from this value on need ZIP64 fields, the header field then holds ZIP64_MARKER
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_MARKER = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+# Members up to this size are compressed in memory and sent back to the writer,
+# bigger ones are spilled to a temporary file next to the archive
+SPILL_SIZE = 4 * 1024 * 1024
+# Batches compressed ahead of the writer per worker
+WINDOW_PER_WORKER = 2
+# Small members go to the workers in batches of up to this many files and bytes, so the
+# round trip to a worker process isn't paid per file
+BATCH_FILES = 256
+BATCH_BYTES = SPILL_SIZE
+# UTF-8 file name flag
+FLAG_UTF8 = 0x800
+
+# Compress one file. Returns (method, crc, size, compressed_size, mtime, mode, payload, file_hash, measured),
+# payload being the member data, ("spill", path) or ("source", None) when the file is stored as it is,
+# and measured the (bytes in, bytes out) the compression policy learns from. decision is one of the
+# compressibility decisions: a sniffed file whose first block doesn't deflate is stored from there on.
+def compress_member(src, level, buffer_size, spill_dir, algorithm=None, decision=COMPRESS):
+    stat = os.stat(src)
+    small = stat.st_size <= SPILL_SIZE
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if decision != STORE else None
+    file_hash = new_hash(algorithm) if algorithm else None
+    spill_path = None
+    out = None
+    raw = []
+    measured = None
+    crc = 0
+    size = 0
+    try:
+        with open(src, "rb") as f:
+            while True:
+                chunk = f.read(buffer_size)
+                if not chunk:
+                    break
+                if decision == SNIFF and measured is None:
+                    measured = sniff(chunk)
+                    if not worth_compressing(*measured):
+                        compressor = None
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                if file_hash is not None:
+                    file_hash.update(chunk)
+                if small:
+                    raw.append(chunk)
+                if compressor is None:
+                    continue
+                if out is None:
+                    if small:
+                        out = io.BytesIO()
+                    else:
+                        fd, spill_path = tempfile.mkstemp(dir=spill_dir, suffix=".deflate")
+                        out = os.fdopen(fd, "wb")
+                out.write(compressor.compress(chunk))
+        if compressor is not None:
+            if out is None:
+                out = io.BytesIO()
+            out.write(compressor.flush())
+            compressed_size = out.tell()
+            measured = (size, compressed_size)
+    finally:
+        if spill_path is not None:
+            out.close()
+    digest = file_hash.hexdigest() if file_hash is not None else None
+    if compressor is None or compressed_size >= size:
+        # Incompressible: store it, the writer copies a big file itself
+        if spill_path is not None:
+            os.remove(spill_path)
+        payload = b"".join(raw) if small else ("source", None)
+        return ZIP_STORED, crc, size, size, stat.st_mtime, stat.st_mode, payload, digest, measured
+    if spill_path is not None:
+        return ZIP_DEFLATED, crc, size, compressed_size, stat.st_mtime, stat.st_mode, ("spill", spill_path), digest, measured
+    return ZIP_DEFLATED, crc, size, compressed_size, stat.st_mtime, stat.st_mode, out.getvalue(), digest, measured
+
+# compress_member() for a batch of (src, algorithm, decision); a file that fails gives its exception
+def compress_members(batch, level, buffer_size, spill_dir):
+    results = []
+    for src, algorithm, decision in batch:
+        try:
+            results.append(compress_member(src, level, buffer_size, spill_dir, algorithm, decision))
+        except (OSError, ValueError) as err:
+            results.append(err)
+    return results
+
+def _dos_date_time(mtime):
+    t = time.localtime(mtime)
+    year = min(max(t.tm_year, 1980), 2107)
+    if year != t.tm_year:
+        return ((year - 1980) << 9) | (1 << 5) | 1, 0
+    return ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday, (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+
+def _encode_name(arcname):
+    try:
+        return arcname.encode("ascii"), 0
+    except UnicodeEncodeError:
+        return arcname.encode("utf-8"), FLAG_UTF8
+
+class ParallelZipWriter:
+    def __init__(self, archive_path, level=6, workers=0, buffer_size=1024 * 1024, policy=None):
+        self.archive_path = archive_path
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.buffer_size = buffer_size
+        self.policy = policy
+        self.file = open(archive_path, "wb")
+        self.spill_dir = tempfile.mkdtemp(prefix="backutil_zip_", dir=os.path.dirname(os.path.abspath(archive_path)))
+        # Central directory entries: (name, flags, method, date, time, crc, compressed_size, size, mode, offset)
+        self.entries = []
+        # arcname -> (name, header offset, compressed size), like read_archive_members
+        self.members = {}
+        # arcname -> (crc, size) for verify_zip
+        self.checksums = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _write_member(self, arcname, method, crc, size, compressed_size, mtime, mode, payload, src=None):
+        name, flags = _encode_name(arcname)
+        dos_date, dos_time = _dos_date_time(mtime)
+        zip64 = size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT
+        extra = struct.pack("<HHQQ", 1, 16, size, compressed_size) if zip64 else b""
+        offset = self.file.tell()
+        self.file.write(struct.pack("<IHHHHHIIIHH", 0x04034b50, 45 if zip64 else 20, flags, method, dos_time, dos_date, crc,
+                                    ZIP64_MARKER if zip64 else compressed_size, ZIP64_MARKER if zip64 else size, len(name), len(extra)))
+        self.file.write(name)
+        self.file.write(extra)
+        if isinstance(payload, bytes):
+            self.file.write(payload)
+        else:
+            kind, spill_path = payload
+            with open(spill_path if kind == "spill" else src, "rb") as f:
+                shutil.copyfileobj(f, self.file, self.buffer_size)
+            if kind == "spill":
+                os.remove(spill_path)
+        self.entries.append((name, flags, method, dos_date, dos_time, crc, compressed_size, size, mode, offset))
+        self.members[arcname] = (arcname, offset, compressed_size)
+        self.checksums[arcname] = (crc, size)
+        self.bytes_in += size
+        self.bytes_out += compressed_size
+
+    # Compress and append files in order. entries yields (tag, src, arcname, algorithm, size); for
+    # every entry yields (tag, file_hash, error) once it is in the archive (or failed, and left out).
+    def write_files(self, entries):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()
+            batches = self._batches(entries)
+            while True:
+                while len(pending) < self.workers * WINDOW_PER_WORKER:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    members = [(src, algorithm, self._decide(arcname)) for tag, src, arcname, algorithm, size in batch]
+                    future = executor.submit(compress_members, members, self.level, self.buffer_size, self.spill_dir)
+                    pending.append((batch, future))
+                if not pending:
+                    return
+                batch, future = pending.popleft()
+                results = future.result()
+                for (tag, src, arcname, algorithm, size), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        yield tag, None, result
+                        continue
+                    method, crc, size, compressed_size, mtime, mode, payload, file_hash, measured = result
+                    self._write_member(arcname, method, crc, size, compressed_size, mtime, mode, payload, src)
+                    if self.policy is not None:
+                        self.policy.record(arcname, measured)
+                    yield tag, file_hash, None
+
+    def _decide(self, arcname):
+        return self.policy.decide(arcname) if self.policy is not None else COMPRESS
+
+    @staticmethod
+    def _batches(entries):
+        batch = []
+        batch_bytes = 0
+        for entry in entries:
+            batch.append(entry)
+            batch_bytes += entry[4]
+            if len(batch) >= BATCH_FILES or batch_bytes >= BATCH_BYTES:
+                yield batch
+                batch = []
+                batch_bytes = 0
+        if batch:
+            yield batch
+
+    def writestr(self, arcname, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        method = ZIP_DEFLATED
+        if len(compressed) >= len(data):
+            method, compressed = ZIP_STORED, data
+        self._write_member(arcname, method, zlib.crc32(data), len(data), len(compressed), time.time(), 0o100644, compressed)
+
+    def close(self):
+        try:
+            cd_offset = self.file.tell()
+            made_by = (0 if os.name == "nt" else 3) << 8 | 45
+            for name, flags, method, dos_date, dos_time, crc, compressed_size, size, mode, offset in self.entries:
+                zip64 = []
+                if size >= ZIP64_LIMIT or compressed_size >= ZIP64_LIMIT:
+                    zip64 += [size, compressed_size]
+                    size = compressed_size = ZIP64_MARKER
+                if offset >= ZIP64_LIMIT:
+                    zip64.append(offset)
+                    offset = ZIP64_MARKER
+                extra = struct.pack("<HH" + "Q" * len(zip64), 1, 8 * len(zip64), *zip64) if zip64 else b""
+                self.file.write(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, made_by, 45 if zip64 else 20, flags, method,
+                                            dos_time, dos_date, crc, compressed_size, size, len(name), len(extra), 0, 0, 0,
+                                            (mode & 0xFFFF) << 16, offset))
+                self.file.write(name)
+                self.file.write(extra)
+            cd_end = self.file.tell()
+            count = len(self.entries)
+            cd_size = cd_end - cd_offset
+            if count >= ZIP_MAX_ENTRIES or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+                self.file.write(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, made_by, 45, 0, 0, count, count, cd_size, cd_offset))
+                self.file.write(struct.pack("<IIQI", 0x07064b50, 0, cd_end, 1))
+            self.file.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, min(count, ZIP_MAX_ENTRIES), min(count, ZIP_MAX_ENTRIES),
+                                        min(cd_size, ZIP64_MARKER), min(cd_offset, ZIP64_MARKER), 0))
+        finally:
+            self.file.close()
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    # Give up on the archive: close it and remove it with the spill files
+    def abort(self):
+        self.file.close()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+        if os.path.exists(self.archive_path):
+            os.remove(self.archive_path)
+
+# Deflate the session folder into a ZIP with zip_workers processes at zip_compression_level,
+# the compressing counterpart of create_zip_file_from_folder, and verify it. Every member that
+# can't be read is logged and fails the attempt (the catalog records every copied file as backed
+# up, so the archive must hold them all); a failed archive is retried like
+# create_lz4_file_from_folder retries, and when the disk is full on_disk_full(config) gets the
+# chance to make room first.
+def create_parallel_zip_from_folder(src_dir, archive_path, config, retries=3, retry_delay=10, on_disk_full=None):
+    start_time_zip = datetime.now()
+    log(f"Creating compressed zip file from folder: {src_dir}", "Attempt")
+    entries = []
+    folders = [src_dir]
+    while folders:
+        with os.scandir(folders.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(entry.path)
+                elif entry.is_file():
+                    arcname = os.path.relpath(entry.path, src_dir).replace(os.sep, "/")
+                    entries.append((entry.path, entry.path, arcname, None, entry.stat().st_size))
+    for i in range(retries):
+        policy = load_policy(config) if config.zip_skip_incompressible else None
+        writer = None
+        skipped = 0
+        try:
+            writer = ParallelZipWriter(archive_path, config.zip_compression_level, config.zip_workers, config.buffer_size, policy)
+            for src, file_hash, err in writer.write_files(entries):
+                if err is None:
+                    continue
+                if isinstance(err, OSError) and err.errno == errno.ENOSPC:
+                    # Out of room for the spill files, not a problem of the member
+                    raise err
+                log(f"Error: can't add {src} to the zip file: {err}", "Failure")
+                skipped += 1
+            if skipped:
+                raise OSError(f"{skipped} files couldn't be read into the zip file")
+            writer.close()
+            if policy is not None:
+                save_policy(config, policy)
+            break
+        except Exception as err:
+            if writer is not None:
+                writer.abort()
+            elif os.path.exists(archive_path):
+                os.remove(archive_path)
+            if getattr(err, "errno", None) == errno.ENOSPC:  # No space left
+                log(f"Error creating zip file: {err}!", "Failure")
+                if on_disk_full is not None:
+                    on_disk_full(config)
+            else:
+                log(f"Unexpected error encountered during zip file creation: {err}", "Error")
+                log(f"Traceback: {traceback.format_exc()}", "Error")
+            if i < retries - 1:
+                log(f"Zip file creation failed ({err}). Retrying in {retry_delay} seconds...", "Warning")
+                time.sleep(retry_delay)
+            else:
+                log(f"Zip file creation failed ({err}).", "Failure")
+                return False
+    duration = datetime.now() - start_time_zip
+    duration_str = str(duration).split('.')[0]  # Remove the fractional seconds
+    ratio = writer.bytes_out / writer.bytes_in if writer.bytes_in else 1
+    log(f"zip file created successfully with {writer.workers} workers: {writer.bytes_in / 1048576:.0f} MB -> "
+        f"{writer.bytes_out / 1048576:.0f} MB ({ratio:.0%}), duration: {duration_str}", "Success")
+    if policy is not None:
+        log(f"Compression decisions: {policy.summary()}", "INFORMA")
+    return verify_zip(archive_path, writer.checksums, config)
@@ -0,0 +1,223 @@
+import os
+import time
+import errno
+import queue
+import shutil
+import sqlite3
+import threading
+from datetime import datetime
+from submain import log, generate_hash, copy_file_to_staging, StagingLayout
+
+# Marks the end of a stage's input
+_DONE = object()
+
+# Check the free space on the backup drive after this many bytes have been copied. The archive
+# made from the session folder afterwards needs about as much room as the files copied so far,
+# plus this reserve.
+FREE_SPACE_CHECK_BYTES = 256 * 1024 * 1024
+FREE_SPACE_RESERVE = 1024 * 1024 * 1024
+# Copied files are inserted into the tracker DB in batches of this many rows
+TRACKER_BATCH = 1000
+
+# Content index of a streaming backup: hash -> first path with that content. It is kept in a
+# private temporary SQLite database (spilled to disk past its page cache) rather than a dict, so
+# memory stays flat whatever the number of distinct files. Callers serialize access.
+class ContentIndex:
+    def __init__(self):
+        self.conn = sqlite3.connect("", check_same_thread=False)
+        self.conn.execute("CREATE TABLE content_index(hash TEXT PRIMARY KEY, file TEXT) WITHOUT ROWID;")
+
+    # The first path recorded for file_hash, recording file_path when the content is new
+    def first_path(self, file_hash, file_path):
+        if self.conn.execute("INSERT OR IGNORE INTO content_index (hash, file) VALUES (?, ?);", (file_hash, file_path)).rowcount:
+            return file_path
+        return self.conn.execute("SELECT file FROM content_index WHERE hash = ?;", (file_hash,)).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+# Bounded queue between two pipeline stages.
+# put_stall is the time producers spent blocked on a full queue (the consumer is the bottleneck),
+# get_stall is the time consumers spent waiting on an empty queue (the producer is the bottleneck).
+class StageQueue:
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.queue = queue.Queue(maxsize)
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.items = 0
+        self.depth_total = 0
+        self.max_depth = 0
+        self.put_stall = 0.0
+        self.get_stall = 0.0
+
+    def put(self, item):
+        start = time.perf_counter()
+        self.queue.put(item)
+        waited = time.perf_counter() - start
+        depth = self.queue.qsize()
+        with self.lock:
+            if item is not _DONE:
+                self.items += 1
+            self.depth_total += depth
+            self.max_depth = max(self.max_depth, depth)
+            self.put_stall += waited
+
+    def get(self):
+        start = time.perf_counter()
+        item = self.queue.get()
+        waited = time.perf_counter() - start
+        with self.lock:
+            self.get_stall += waited
+        return item
+
+    def summary(self):
+        avg_depth = self.depth_total / max(self.items, 1)
+        return (f"Queue {self.name}: {self.items} items, depth avg {avg_depth:.1f} max {self.max_depth}/{self.maxsize}, "
+                f"producers blocked {self.put_stall:.1f}s, consumers waiting {self.get_stall:.1f}s")
+
+# Streaming full backup: scan -> hash -> copy stages connected by bounded queues.
+# records yields (drive, file_path, mtime, size, file_id); every copied file is inserted into the
+# tracker DB as it completes, so the full file list is never held in Python memory. Files whose
+# content was already seen go straight to the tracker as duplicates of the first path.
+def run_streaming_backup(records, staging_folder, backup_folder, config):
+    log("Streaming files through scan, hash and copy stages...", "Attempt")
+    start_time_pipeline = datetime.now()
+    hash_workers = config.max_threads
+    copy_workers = config.max_threads
+    hash_queue = StageQueue("scan->hash", config.pipeline_queue_size)
+    copy_queue = StageQueue("hash->copy", config.pipeline_queue_size)
+    result_queue = StageQueue("copy->catalog", config.pipeline_queue_size)
+    content_index = ContentIndex()
+    lock = threading.Lock()
+    state = {'hashers_left': hash_workers, 'bytes_since_check': 0, 'bytes_copied': 0, 'error': None}
+    # Session folders are created the first time a file needs them
+    layout = StagingLayout(os.path.join(staging_folder, backup_folder))
+
+    def scan_stage():
+        try:
+            for record in records:
+                # Stop walking the tree once the backup has failed
+                if state['error'] is not None:
+                    break
+                hash_queue.put(record)
+        except Exception as err:
+            log(f"Error during file scan: {err}", "Failure")
+            state['error'] = err
+        finally:
+            for _ in range(hash_workers):
+                hash_queue.put(_DONE)
+
+    def hash_stage():
+        while True:
+            record = hash_queue.get()
+            if record is _DONE:
+                break
+            # Keep draining after a fatal error, without hashing, so the scan never blocks
+            if state['error'] is not None:
+                continue
+            drive, file_path, mtime, size, file_id = record
+            try:
+                file_hash = generate_hash(file_path, config)
+            except Exception as exc:
+                log(f"Couldn't generate hash for {file_path}: {exc}", "Warning")
+                continue
+            with lock:
+                first_path = content_index.first_path(file_hash, file_path)
+            if first_path != file_path:
+                result_queue.put((drive, file_path, file_hash, mtime, size, first_path))
+                continue
+            copy_queue.put((drive, file_path, file_hash, mtime, size))
+        # The last hasher to finish tells the copiers there is nothing more to come
+        with lock:
+            state['hashers_left'] -= 1
+            last = state['hashers_left'] == 0
+        if last:
+            for _ in range(copy_workers):
+                copy_queue.put(_DONE)
+
+    def copy_stage():
+        while True:
+            backup_file = copy_queue.get()
+            if backup_file is _DONE:
+                break
+            # Keep draining after a fatal error so the upstream stages never block
+            if state['error'] is not None:
+                continue
+            try:
+                copy_file_to_staging(backup_file, layout, config.buffer_size)
+                result_queue.put(backup_file + (None,))
+            except FileNotFoundError:
+                log(f"Error: Path not found in the latest VSS snapshot: {backup_file[1]}", "failure")
+                continue
+            except Exception as e:
+                log(f"Error: {e}", "failure")
+                continue
+            with lock:
+                state['bytes_since_check'] += backup_file[4]
+                state['bytes_copied'] += backup_file[4]
+                check_now = state['bytes_since_check'] >= FREE_SPACE_CHECK_BYTES
+                if check_now:
+                    state['bytes_since_check'] = 0
+                    space_needed = state['bytes_copied'] + FREE_SPACE_RESERVE
+            if check_now and state['error'] is None and shutil.disk_usage(staging_folder).free < space_needed:
+                log("There is not enough free space on the backup drive", "Warning")
+                state['error'] = OSError(errno.ENOSPC, "Not enough free space on the backup drive", staging_folder)
+        result_queue.put(_DONE)
+
+    threads = [threading.Thread(target=scan_stage, name="scan")]
+    threads += [threading.Thread(target=hash_stage, name=f"hash-{i + 1}") for i in range(hash_workers)]
+    threads += [threading.Thread(target=copy_stage, name=f"copy-{i + 1}") for i in range(copy_workers)]
+    for thread in threads:
+        thread.start()
+
+    # The tracker DB connection belongs to this thread, so it records the copied files itself
+    copiers_left = copy_workers
+    num_files = 0
+    num_duplicates = 0
+    config.total_size = 0
+    rows = []
+    try:
+        while copiers_left:
+            backup_file = result_queue.get()
+            if backup_file is _DONE:
+                copiers_left -= 1
+                continue
+            rows.append(backup_file)
+            if len(rows) >= TRACKER_BATCH:
+                config.tracker_db_cursor.executemany("INSERT INTO backutil_tracker (drive, file, hash, mtime, size, dup_of) VALUES (?, ?, ?, ?, ?, ?);", rows)
+                rows = []
+            if backup_file[5] is None:
+                num_files += 1
+                config.total_size += backup_file[4]
+            else:
+                num_duplicates += 1
+        config.tracker_db_cursor.executemany("INSERT INTO backutil_tracker (drive, file, hash, mtime, size, dup_of) VALUES (?, ?, ?, ?, ?, ?);", rows)
+        config.tracker_db_conn.commit()
+    except Exception as err:
+        log(f"Error recording copied files in the tracker DB: {err}", "Failure")
+        state['error'] = err
+        # The stages stop on the error; take what they still send so none of them blocks
+        while copiers_left:
+            if result_queue.get() is _DONE:
+                copiers_left -= 1
+    for thread in threads:
+        thread.join()
+    content_index.close()
+
+    for stage_queue in (hash_queue, copy_queue, result_queue):
+        log(stage_queue.summary(), "Success")
+    if state['error'] is not None:
+        raise state['error']
+    import vss_snapshot
+    log(f"Backed up {num_files} files ({vss_snapshot.format_folder_size(config.total_size)}), {num_duplicates} duplicates recorded as references", "Success")
+    end_time_pipeline = datetime.now()
+    duration = end_time_pipeline - start_time_pipeline
+    duration_str = str(duration).split('.')[0]  # Remove the fractional seconds
+    log('Streaming backup Duration: ' + duration_str, "Success")
+
+# Copied files as (hash, details) pairs read back from the tracker DB, in the same shape
+# copy_files_pool returns, without building the whole dict in memory
+def iter_tracker_backed_up_items(config):
+    for drive, file, file_hash, mtime, size in config.tracker_db_conn.execute("SELECT drive, file, hash, mtime, size FROM backutil_tracker WHERE dup_of IS NULL;"):
+        yield file_hash, {"status": "Y", "drive": drive, "file": file, "mtime": mtime, "size": size}
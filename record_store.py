@@ -0,0 +1,66 @@
+import os
+from array import array
+
+# Compact table of the files found by the scan.
+# Drives and parent folders are interned once and referenced by index, mtime and size live in
+# typed arrays, so a file costs its name plus about 30 bytes instead of a path string and a
+# three key dict. Everything after the scan passes record indices around instead of tuples.
+class FileRecordStore:
+    __slots__ = ('drives', 'drive_ids', 'dirs', 'dir_ids', 'drive_idx', 'dir_idx', 'names', 'mtimes', 'sizes', 'file_ids', 'hashes')
+
+    def __init__(self):
+        self.drives = []
+        self.drive_ids = {}
+        self.dirs = []
+        self.dir_ids = {}
+        self.drive_idx = array('H')
+        self.dir_idx = array('I')
+        self.names = []
+        self.mtimes = array('d')
+        self.sizes = array('q')
+        # NTFS file index / inode, 0 where the scan could not get it for free
+        self.file_ids = array('Q')
+        self.hashes = []
+
+    def __len__(self):
+        return len(self.names)
+
+    # Add a file and return its record index
+    def add(self, drive, file_path, mtime, size, file_id=0):
+        dir_path, name = os.path.split(file_path)
+        drive_id = self.drive_ids.get(drive)
+        if drive_id is None:
+            drive_id = self.drive_ids[drive] = len(self.drives)
+            self.drives.append(drive)
+        dir_id = self.dir_ids.get(dir_path)
+        if dir_id is None:
+            dir_id = self.dir_ids[dir_path] = len(self.dirs)
+            self.dirs.append(dir_path)
+        self.drive_idx.append(drive_id)
+        self.dir_idx.append(dir_id)
+        self.names.append(name)
+        self.mtimes.append(mtime)
+        self.sizes.append(size)
+        self.file_ids.append(file_id)
+        self.hashes.append(None)
+        return len(self.names) - 1
+
+    def path(self, index):
+        return os.path.join(self.dirs[self.dir_idx[index]], self.names[index])
+
+    def drive(self, index):
+        return self.drives[self.drive_idx[index]]
+
+    def dir_path(self, index):
+        return self.dirs[self.dir_idx[index]]
+
+    # Same layout as a backutil_tracker row: (drive, file, hash, mtime, size)
+    def record(self, index):
+        return (self.drives[self.drive_idx[index]], self.path(index), self.hashes[index],
+                self.mtimes[index], self.sizes[index])
+
+    def total_size(self, indices=None):
+        if indices is None:
+            return sum(self.sizes)
+        sizes = self.sizes
+        return sum(sizes[index] for index in indices)
@@ -0,0 +1,51 @@
+import os
+import re
+from datetime import datetime
+from submain import log, manage_previous_db
+from catalog import delete_run_dates, reclaim_catalog_space, get_maintenance, set_maintenance, catalog_file_size
+
+# Archives past the retention policy (incremental backups to keep, full backups to keep),
+# newest first within each kind
+def expired_backups(backup_files, delete_retention_policy):
+    incremental_backups_to_keep, full_backups_to_keep = delete_retention_policy[0], delete_retention_policy[1]
+    full_backups = [name for name in backup_files if name.startswith('Full-') and re.search(r'\d{8}', name)]
+    incremental_backups = [name for name in backup_files if name.startswith('Incremental-') and re.search(r'\d{8}', name)]
+    backup_date = lambda name: datetime.strptime(re.search(r'\d{8}', name).group(), '%Y%m%d')
+    full_backups.sort(key=backup_date, reverse=True)
+    incremental_backups.sort(key=backup_date, reverse=True)
+    return full_backups[full_backups_to_keep:] + incremental_backups[incremental_backups_to_keep:]
+
+# Drop the catalog runs of every expired backup in one transaction, then reclaim the freed space
+# when the last reclamation is catalog_vacuum_days old, and report the catalog size.
+def prune_catalog(config, expired):
+    dates = sorted({re.search(r'\d{8}', name).group() for name in expired})
+    size_before = catalog_file_size(config.previous_db_name)
+    manage_previous_db(config, "open")
+    try:
+        deleted = delete_run_dates(config.previous_db_conn, dates)
+        today = datetime.now()
+        last_vacuum = get_maintenance(config.previous_db_conn, "last_vacuum")
+        if last_vacuum is None or (today - datetime.strptime(last_vacuum, '%Y%m%d')).days >= config.catalog_vacuum_days:
+            reclaim_catalog_space(config.previous_db_conn)
+            set_maintenance(config.previous_db_conn, "last_vacuum", today.strftime('%Y%m%d'))
+            log("Catalog free pages reclaimed.", "Success")
+    finally:
+        manage_previous_db(config, "close")
+    size_after = catalog_file_size(config.previous_db_name)
+    import vss_snapshot
+    log(f"Removed {deleted} catalog runs for {len(dates)} expired backup dates, catalog size "
+        f"{vss_snapshot.format_folder_size(size_before)} -> {vss_snapshot.format_folder_size(size_after)}.", "Success")
+
+# Retention engine: works out every expired archive up front, prunes the catalog once, then
+# deletes the archive files
+def delete_old_backups(backup_directory, delete_retention_policy, config):
+    log("Deleting previous backups in line with rotation configuration...", "Attempt")
+    expired = expired_backups(os.listdir(backup_directory), delete_retention_policy)
+    if not expired:
+        log("No backups past the retention policy.", "Success")
+        return
+    prune_catalog(config, expired)
+    for backup_file in expired:
+        os.remove(os.path.join(backup_directory, backup_file))
+        kind = "full" if backup_file.startswith('Full-') else "incremental"
+        log(f'Deleted old {kind} backup: {backup_file}', "Success")
@@ -0,0 +1,126 @@
+import os
+import re
+import time
+import fnmatch
+
+# Rules used when config.ini has no [EXCLUDE] section (the old hard-coded skip list)
+DEFAULT_EXCLUDE_RULES = [
+    ('temp_files', 'glob:*.tmp;*.temp;*.swp;*.ini;*.lnk;*.db;*.rdp;~$*'),
+]
+
+SIZE_UNITS = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+# Exclude rules, one per key in the [EXCLUDE] section of config.ini or per "-" line in backup_list.txt:
+#   glob:*.tmp;~$*            file name globs
+#   regex:\\Cache\\.*\.dat$   regular expression on the full file path
+#   dir:node_modules;AppData\Local\Temp
+#                             folder name or trailing folder path globs, pruned before descending
+#   larger_than:4GB           files bigger than the size
+#   older_than:365            files not modified for the number of days
+# All patterns of a kind are compiled once into a single regex with one named group per rule,
+# so a file or folder is tested with one match call whatever the number of rules.
+class ExcludeRules:
+    def __init__(self, specs):
+        self.names = []
+        self.files = []
+        self.bytes = []
+        self.folders = []
+        self.size_rules = []
+        self.age_rules = []
+        name_patterns = []
+        path_patterns = []
+        dir_patterns = []
+        for name, spec in specs:
+            kind, _, pattern = spec.partition(':')
+            kind = kind.strip().lower()
+            pattern = pattern.strip()
+            index = len(self.names)
+            self.names.append(name)
+            self.files.append(0)
+            self.bytes.append(0)
+            self.folders.append(0)
+            group = f"r{index}"
+            if kind == 'glob':
+                globs = [g.strip() for g in pattern.split(';') if g.strip()]
+                name_patterns.append(f"(?P<{group}>" + "|".join(fnmatch.translate(g) for g in globs) + ")")
+            elif kind == 'regex':
+                re.compile(pattern)  # Fail early on a bad pattern with the rule name in the traceback
+                path_patterns.append(f"(?P<{group}>{pattern})")
+            elif kind == 'dir':
+                globs = [g.strip().strip('\\/') for g in pattern.split(';') if g.strip()]
+                dir_patterns.append(f"(?P<{group}>" + "|".join(dir_glob_to_regex(g) for g in globs) + ")")
+            elif kind == 'larger_than':
+                self.size_rules.append((index, parse_size(pattern)))
+            elif kind == 'older_than':
+                self.age_rules.append((index, time.time() - float(pattern) * 86400))
+            else:
+                raise ValueError(f"Unknown exclude rule type '{kind}' in rule {name}")
+        flags = re.IGNORECASE if os.name == 'nt' else 0
+        self.name_matcher = re.compile("|".join(name_patterns), flags) if name_patterns else None
+        self.path_matcher = re.compile("|".join(path_patterns), flags) if path_patterns else None
+        self.dir_matcher = re.compile("|".join(dir_patterns), flags) if dir_patterns else None
+
+    # True if the folder should not be descended into
+    def prune_dir(self, dir_path):
+        if self.dir_matcher is None:
+            return False
+        match = self.dir_matcher.search(dir_path)
+        if match is None:
+            return False
+        self.folders[int(match.lastgroup[1:])] += 1
+        return True
+
+    # True if the file should be left out of the backup
+    def exclude_file(self, path, name, mtime, size):
+        index = None
+        if self.name_matcher is not None:
+            match = self.name_matcher.match(name)
+            if match is not None:
+                index = int(match.lastgroup[1:])
+        if index is None and self.path_matcher is not None:
+            match = self.path_matcher.search(path)
+            if match is not None:
+                index = int(match.lastgroup[1:])
+        if index is None:
+            for rule_index, limit in self.size_rules:
+                if size > limit:
+                    index = rule_index
+                    break
+        if index is None:
+            for rule_index, cutoff in self.age_rules:
+                if mtime < cutoff:
+                    index = rule_index
+                    break
+        if index is None:
+            return False
+        self.files[index] += 1
+        self.bytes[index] += size
+        return True
+
+    # (rule name, files excluded, bytes excluded, folders pruned) for every rule
+    def summary(self):
+        return list(zip(self.names, self.files, self.bytes, self.folders))
+
+# A folder glob matches the last path components of a folder, e.g. AppData\Local\Temp
+def dir_glob_to_regex(pattern):
+    parts = re.split(r'[\\/]+', pattern)
+    translated = []
+    for part in parts:
+        # fnmatch.translate anchors with \Z, keep only the body so the parts can be joined
+        body = fnmatch.translate(part)
+        body = body[4:-3] if body.startswith('(?s:') and body.endswith(')\\Z') else body
+        translated.append(body.replace('.*', '[^\\\\/]*'))
+    return r"(?:^|[\\/])" + r"[\\/]".join(translated) + r"$"
+
+def parse_size(value):
+    value = value.strip().upper()
+    for unit, factor in SIZE_UNITS.items():
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * factor)
+    return int(value)
+
+# Read the rule specs from the [EXCLUDE] section, or the default skip list if it is missing
+def load_exclude_specs(config_file):
+    if config_file.has_section('EXCLUDE'):
+        return list(config_file.items('EXCLUDE', raw=True))
+    return list(DEFAULT_EXCLUDE_RULES)
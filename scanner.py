@@ -0,0 +1,58 @@
+import os
+import concurrent.futures
+from submain import log
+
+# Read a single directory with os.scandir.
+# Returns the files as (path, name, mtime, size, file_id) tuples and the sub folders to descend into.
+# DirEntry caches the stat data returned by the directory read (on Windows it comes for
+# free with FindNextFile), so every file costs one directory entry instead of the old
+# os.access + getmtime + getsize round trips.
+# file_id is the st_ino of the listing, 0 where the listing doesn't carry it (Windows), which the
+# hash cache takes as unknown.
+def scan_directory(dir_path):
+    files = []
+    subdirs = []
+    num_dirs = 0
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        num_dirs += 1
+                        # Same rule as os.walk: count linked folders but don't descend into them
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    else:
+                        stat = entry.stat()
+                        files.append((entry.path, entry.name, stat.st_mtime, stat.st_size, stat.st_ino))
+                except FileNotFoundError:
+                    log(f"Error: File not found or inaccessible: {entry.path}", "Failure")
+                except OSError as e:
+                    log(f"Error processing file {entry.path}: {e}", "Failure")
+    except OSError as e:
+        log(f"Error: Insufficient permissions to read folder: {dir_path} ({e})", "Failure")
+    return dir_path, files, subdirs, num_dirs
+
+# Walk one or more folder trees, fanning the directories out across a thread pool.
+# Yields (dir_path, files, subdirs, num_dirs) for every folder as soon as it has been read,
+# so callers can consume results while the rest of the tree is still being listed.
+# Folders matched by an ExcludeRules dir rule are dropped before they are read.
+def scan_tree(top_paths, max_workers, rules=None):
+    if isinstance(top_paths, str):
+        top_paths = [top_paths]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(scan_directory, path) for path in top_paths}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                dir_path, files, subdirs, num_dirs = future.result()
+                if rules is not None:
+                    subdirs = [subdir for subdir in subdirs if not rules.prune_dir(subdir)]
+                for subdir in subdirs:
+                    pending.add(executor.submit(scan_directory, subdir))
+                yield dir_path, files, subdirs, num_dirs
+
+def format_scan_rate(num_files, seconds):
+    if seconds <= 0:
+        return f"{num_files} files"
+    return f"{num_files} files in {seconds:.1f}s ({num_files / seconds:.0f} files/sec)"
@@ -1,4 +1,4 @@
-import time, sqlite3, os, subprocess, colorama
+import time, sqlite3, os, subprocess, colorama, mmap, threading, csv, io
 import psutil, configparser
 from datetime import datetime
 import shutil
@@ -6,6 +6,20 @@ from termcolor import colored
 import concurrent.futures
 import xxhash
 from cryptography.fernet import Fernet
+from rules import load_exclude_specs
+from copy_engine import copy_file, method_counts, DEFAULT_BUFFER
+from catalog import open_catalog, has_catalog, write_run, read_archive_members, delete_run_dates, LEGACY_HASH_ALGORITHM
+
+# Hash algorithm used when config.ini does not name one
+DEFAULT_HASH_ALGORITHM = "xxh3_128"
+
+# Session folder file listing the duplicate paths and the path their content is stored under
+DUPLICATES_MANIFEST = "duplicates.csv"
+# Values of the archive_format option
+ARCHIVE_FORMATS = ('auto', 'zip', '.tar.lz4', '.tar.zst')
+# Values of the archive_verify option: a sample of the members read back (and the zip central
+# directory checked), or every member
+VERIFY_MODES = ('quick', 'full')
 
 def clear_log():
     log_file = open('backutil_log.txt', 'w')
@@ -39,7 +53,7 @@ def manage_tracker_db(config, action):
         log("Opening tracker DB...", "Attempt")
         config.tracker_db_conn = sqlite3.connect(config.tracker_db_name)
         config.tracker_db_cursor = config.tracker_db_conn.cursor()
-        config.tracker_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_tracker(drive TEXT, file TEXT, hash TEXT, mtime TEXT,size TEXT);")
+        config.tracker_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_tracker(drive TEXT, file TEXT, hash TEXT, mtime TEXT,size TEXT, idx INTEGER, dup_of TEXT);")
         log("Tracker DB opened successfully.", "Success")
     # Close DB
     if action == "close":
@@ -52,9 +66,8 @@ def manage_previous_db(config, action):
     # Open/create DB
     if action == "open":
         log("Opening previous backups DB...", "Attempt")
-        config.previous_db_conn = sqlite3.connect(config.previous_db_name)
+        config.previous_db_conn = open_catalog(config.previous_db_name)
         config.previous_db_cursor = config.previous_db_conn.cursor()
-        config.previous_db_cursor.execute("CREATE TABLE IF NOT EXISTS backutil_previous(date TEXT, hash TEXT, mtime TEXT,size TEXT);")
         log("Previous backups DB opened successfully.", "Success")
     # Close DB
     if action == "close":
@@ -62,6 +75,20 @@ def manage_previous_db(config, action):
         config.previous_db_conn.close()
         log("Previous backups DB closed successfully.", "Success")
 
+# Incremental backups compare against the catalog, so they keep the algorithm of the newest
+# catalog rows; a different hash_algorithm takes effect with the next full backup.
+def use_catalog_hash_algorithm(config):
+    if not has_catalog(config.previous_db_name):
+        return
+    conn = open_catalog(config.previous_db_name)
+    try:
+        row = conn.execute("SELECT algo FROM backutil_runs ORDER BY date DESC, run_id DESC LIMIT 1;").fetchone()
+    finally:
+        conn.close()
+    if row and row[0] and row[0] != config.hash_algorithm:
+        log(f"The last backup used {row[0]} hashes, keeping it until the next full backup switches to {config.hash_algorithm}.", "INFORMA")
+        config.hash_algorithm = row[0]
+
 # Get Most free space in volumes
 def get_fixed_disk_with_most_free_space():
     log("Get Most free space in volumes...", "Attempt")
@@ -104,7 +131,11 @@ def read_objects_to_backup_from_file(config):
         with open(config.source_directory) as f:
             lines = f.readlines()
             backup_list = []
-            for line in lines:
+            for line_number, line in enumerate(lines, 1):
+                # "-glob:*.iso" style lines are exclude rules, not paths
+                if line.startswith('-'):
+                    config.exclude_specs.append((f"backup_list_line_{line_number}", line[1:].strip()))
+                    continue
                 path = line.strip().format(username=config.user_name)
                 # backup_list.append(line.strip().format(username=os.getlogin()))
                 if os.path.exists(path):
@@ -120,80 +151,417 @@ def read_objects_to_backup_from_file(config):
     return backup_list
 
 # Split backup_files and generate hashes in multiple subprocesses
-def split_and_generate_hashes(backup_files, config):
+# indices are record indices into config.backup_files (a FileRecordStore)
+def split_and_generate_hashes(indices, config):
     log("Split backup_files and generate hashes in multiple threads...", "Attempt")
     start_time_hash = datetime.now()
+    store = config.backup_files
+    # Unchanged files reuse the hash stored by a previous run
+    from hash_cache import open_hash_cache
+    hash_cache = open_hash_cache(config) if config.hash_cache else None
+    cached_hashes = []
+    indices_to_hash = []
+    for index in indices:
+        file_hash = hash_cache.lookup(store, index) if hash_cache is not None else None
+        if file_hash is None:
+            indices_to_hash.append(index)
+        else:
+            cached_hashes.append((index, file_hash))
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=config.max_threads) as executor:
-        hash_futures = {executor.submit(generate_hash, file, config): file for file in backup_files}
+    hash_results = hash_files(store, indices_to_hash, config)
 
-        combined_dict = {}
-        for future in concurrent.futures.as_completed(hash_futures):
-            file = hash_futures[future]
-            try:
-                #check for Duplicate file 
-                file_hash = future.result()
-                if file_hash in combined_dict.values():
-                    #log(f"Duplicate file found: {file}", "Warning")
-                    continue
-                else:
-                    combined_dict[file] = file_hash
-            except Exception as exc:
-                log(f"Couldn't generate hash for {file}: {exc}", "Warning")
-
-    for key, value in combined_dict.items():
-        drive = config.backup_files[key]['drive']
-        mtime = config.backup_files[key]['mtime']
-        size = config.backup_files[key]['size']
-        query_data = (drive , key, value, mtime, size)
-        config.tracker_db_cursor.execute("INSERT INTO backutil_tracker (drive, file, hash, mtime, size) VALUES (?, ?, ?, ?, ?);", query_data)
-    config.tracker_db_conn.commit()
+    # Content index: hash -> record index of the first file with that content.
+    # Only that file is copied, every other path with the same content is recorded as a
+    # duplicate pointing at it, so it is stored once but stays restorable.
+    first_by_hash = {}
+    duplicates = []
+    def index_content(index, file_hash):
+        store.hashes[index] = file_hash
+        first = first_by_hash.setdefault(file_hash, index)
+        if first != index:
+            duplicates.append(index)
+    for index, file_hash in cached_hashes:
+        index_content(index, file_hash)
+    for index, file_hash, exc in hash_results:
+        if exc is not None:
+            log(f"Couldn't generate hash for {store.path(index)}: {exc}", "Warning")
+            continue
+        if hash_cache is not None:
+            hash_cache.store(store, index, file_hash)
+        index_content(index, file_hash)
+    if hash_cache is not None:
+        hash_cache.close()
+
+    record_content_index(config, first_by_hash.values(), duplicates, first_by_hash)
 
     end_time_hash = datetime.now()
     log("Hashes generated successfully.", "Success")
+    hash_path_stats.report()
     duration = end_time_hash - start_time_hash
     duration_str = str(duration).split('.')[0]  # Remove the fractional seconds
     log('Hashes generated Duration: ' + duration_str, "Success")
 
+# Insert the stored files and their duplicates (dup_of = path of the stored copy) into the tracker DB
+def record_content_index(config, stored, duplicates, first_by_hash):
+    store = config.backup_files
+    config.tracker_db_cursor.executemany("INSERT INTO backutil_tracker (drive, file, hash, mtime, size, idx) VALUES (?, ?, ?, ?, ?, ?);",
+                                         (store.record(index) + (index,) for index in stored))
+    config.tracker_db_cursor.executemany("INSERT INTO backutil_tracker (drive, file, hash, mtime, size, idx, dup_of) VALUES (?, ?, ?, ?, ?, ?, ?);",
+                                         (store.record(index) + (index, store.path(first_by_hash[store.hashes[index]])) for index in duplicates))
+    config.tracker_db_conn.commit()
+    if duplicates:
+        import vss_snapshot
+        log(f"Found {len(duplicates)} duplicate files ({vss_snapshot.format_folder_size(store.total_size(duplicates))}), "
+            "each stored once and recorded as a reference.", "Success")
+
+# Hash store records with the configured engine, yields (index, hash, error)
+def hash_files(store, indices, config):
+    if config.hash_engine == "adaptive":
+        from hash_engine import hash_files_adaptive
+        return hash_files_adaptive(store, indices, config)
+    return hash_files_per_thread(store, indices, config)
+
+# One hashing task per file on a thread pool, yields (index, hash, error) as the files complete
+def hash_files_per_thread(store, indices, config):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.max_threads) as executor:
+        hash_futures = {executor.submit(generate_hash, store.path(index), config): index for index in indices}
+        for future in concurrent.futures.as_completed(hash_futures):
+            index = hash_futures[future]
+            try:
+                file_hash = future.result()
+            except Exception as exc:
+                yield index, None, exc
+            else:
+                yield index, file_hash, None
+
 # Generate hash for a single file
 def generate_hash(filename,config):
-    xxh64_hash = xxhash.xxh64()
-    buffer_size = config.buffer_size  
+    return hash_file(filename, config.buffer_size, config.mmap_threshold, config.hash_algorithm)
+
+# New hash object for an algorithm name as used in config.ini and the catalog's algo column
+def new_hash(algorithm):
+    if algorithm == "xxh3_128":
+        return xxhash.xxh3_128()
+    if algorithm == "xxh3_64":
+        return xxhash.xxh3_64()
+    if algorithm == "xxh64":
+        return xxhash.xxh64()
+    if algorithm == "blake3":
+        # Optional dependency, only needed when hash_algorithm = blake3
+        import blake3
+        return blake3.blake3()
+    raise ValueError(f"Unknown hash algorithm: {algorithm}")
+
+# Takes plain arguments so it can also run in a worker process.
+# Files from mmap_threshold bytes up are hashed straight from a read-only mapping, everything
+# else (and any file that cannot be mapped) is read with readinto into a per-thread buffer that
+# is allocated once, instead of a new bytes object for every block.
+def hash_file(filename, buffer_size, mmap_threshold=0, algorithm=DEFAULT_HASH_ALGORITHM):
+    file_hash = new_hash(algorithm)
+    start = time.perf_counter()
     with open(filename, "rb") as f:
-        for byte_block in iter(lambda: f.read(buffer_size), b""):
-            xxh64_hash.update(byte_block)
-    return xxh64_hash.hexdigest()
+        size = os.fstat(f.fileno()).st_size
+        if mmap_threshold and size >= mmap_threshold:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    with memoryview(mapped) as view:
+                        for offset in range(0, size, buffer_size):
+                            file_hash.update(view[offset:offset + buffer_size])
+                    hash_path_stats.record("mmap", size, time.perf_counter() - start)
+                return file_hash.hexdigest()
+            except (OSError, ValueError):
+                file_hash = new_hash(algorithm)
+                f.seek(0)
+        buffer = getattr(_hash_buffers, "buffer", None)
+        if buffer is None or len(buffer) != buffer_size:
+            buffer = _hash_buffers.buffer = bytearray(buffer_size)
+        with memoryview(buffer) as view:
+            while True:
+                read = f.readinto(buffer)
+                if not read:
+                    break
+                file_hash.update(view[:read])
+    hash_path_stats.record("readinto", size, time.perf_counter() - start)
+    return file_hash.hexdigest()
+
+_hash_buffers = threading.local()
+
+# Copy src to dst and hash it from the same buffer, so the source is read only once
+def copy_and_hash_file(src, dst, buffer_size, algorithm=DEFAULT_HASH_ALGORITHM):
+    file_hash = new_hash(algorithm)
+    start = time.perf_counter()
+    buffer = getattr(_hash_buffers, "buffer", None)
+    if buffer is None or len(buffer) != buffer_size:
+        buffer = _hash_buffers.buffer = bytearray(buffer_size)
+    size = 0
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst, memoryview(buffer) as view:
+        while True:
+            read = fsrc.readinto(buffer)
+            if not read:
+                break
+            file_hash.update(view[:read])
+            fdst.write(view[:read])
+            size += read
+    shutil.copymode(src, dst)
+    hash_path_stats.record("copy+hash", size, time.perf_counter() - start)
+    return file_hash.hexdigest()
+
+# Files, bytes, time and the highest process RSS seen per hash_file read path,
+# so mmap_threshold can be chosen from real numbers. The RSS is sampled once per
+# RSS_SAMPLE_FILES files and when the batch is reported, not for every file.
+RSS_SAMPLE_FILES = 256
+
+class HashPathStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paths = {}
+        self.process = psutil.Process()
+        self.since_sample = 0
+
+    def record(self, path_name, size, seconds):
+        with self.lock:
+            files, total, elapsed, peak = self.paths.get(path_name, (0, 0, 0.0, 0))
+            self.paths[path_name] = (files + 1, total + size, elapsed + seconds, peak)
+            self.since_sample += 1
+            sample = self.since_sample >= RSS_SAMPLE_FILES
+            if sample:
+                self.since_sample = 0
+        if sample:
+            self.sample_rss(path_name)
+
+    def sample_rss(self, path_name):
+        rss = self.process.memory_info().rss
+        with self.lock:
+            if path_name in self.paths:
+                files, total, elapsed, peak = self.paths[path_name]
+                self.paths[path_name] = (files, total, elapsed, max(peak, rss))
 
+    def report(self):
+        for path_name in list(self.paths):
+            self.sample_rss(path_name)
+        with self.lock:
+            paths, self.paths = self.paths, {}
+            self.since_sample = 0
+        for path_name, (files, total, elapsed, peak) in sorted(paths.items()):
+            rate = total / 1048576 / elapsed if elapsed else 0
+            log(f"Hash path {path_name}: {files} files, {total / 1048576:.0f} MB, {rate:.1f} MB/s per thread, peak RSS {peak / 1048576:.0f} MB", "Success")
 
-# Copy files to staging folder
-def copy_files_pool(threadnum, files_to_back_up_thread, staging_folder, backup_time, config):
+hash_path_stats = HashPathStats()
+
+
+# Path of a snapshot file inside the session folder: <drive letter>/<path on the volume>
+def staging_relative_path(drive, backup_path):
     prefix = "c:\\mount\\snapshot_"
+    path = backup_path
+    if backup_path.startswith(prefix):
+        path = backup_path[len(prefix):]
+    if "\\" in path:
+        path = path[path.index("\\") + 1:]
+    return os.path.join(drive.replace(":", ""), path)
+
+# Destination folders in the session folder, worked out once per snapshot folder instead of once
+# per file. prepare() creates every folder a list of records needs in one sorted pass before the
+# copy; folder() creates the ones it hasn't seen yet on first use, for the streaming pipeline.
+class StagingLayout:
+    def __init__(self, session_folder):
+        self.session_folder = session_folder
+        # (drive, snapshot folder) -> created session folder
+        self.folders = {}
+        self.lock = threading.Lock()
+
+    def _target(self, drive, dir_path):
+        # staging_relative_path maps file paths, so map a file in the folder and take its folder
+        return os.path.dirname(os.path.join(self.session_folder, staging_relative_path(drive, os.path.join(dir_path, "_"))))
+
+    def prepare(self, store, indices):
+        targets = {}
+        for drive_id, dir_id in {(store.drive_idx[index], store.dir_idx[index]) for index in indices}:
+            key = (store.drives[drive_id], store.dirs[dir_id])
+            targets[key] = self._target(*key)
+        # Parents sort before their children, so most folders need a single mkdir
+        created = set()
+        for folder in sorted(set(targets.values())):
+            if os.path.dirname(folder) in created:
+                try:
+                    os.mkdir(folder)
+                except FileExistsError:
+                    pass
+                created.add(folder)
+                continue
+            os.makedirs(folder, exist_ok=True)
+            while len(folder) > len(self.session_folder) and folder not in created:
+                created.add(folder)
+                folder = os.path.dirname(folder)
+        with self.lock:
+            self.folders.update(targets)
+        log(f"Created {len(created)} folders in the session folder.", "Success")
+
+    def folder(self, drive, dir_path):
+        folder = self.folders.get((drive, dir_path))
+        if folder is None:
+            folder = self._target(drive, dir_path)
+            os.makedirs(folder, exist_ok=True)
+            with self.lock:
+                self.folders[(drive, dir_path)] = folder
+        return folder
+
+    def destination(self, store, index):
+        return os.path.join(self.folder(store.drive(index), store.dir_path(index)), store.names[index])
+
+# Copy a single backup row (drive, file, hash, mtime, size) to the staging folder
+def copy_file_to_staging(backup_file, layout, buffer_size=DEFAULT_BUFFER):
+    dir_path, name = os.path.split(backup_file[1])
+    copy_file(backup_file[1], os.path.join(layout.folder(backup_file[0], dir_path), name), buffer_size)
+
+# Duplicate files this run records, as (drive, file, hash, mtime, size, stored drive, stored file):
+# the duplicates of content stored in this run, pointing at the path it was stored under, and
+# the duplicate paths that are new since the previous runs while their content is in an earlier
+# archive, pointing at the path of the tracker's first copy. stored is this run's
+# {hash: details} as copy_files_pool returns it, None when every first copy in the tracker was
+# stored (the streaming pipeline). Duplicates whose content should have been stored in this run
+# but wasn't (its copy failed) are left out and appended to dropped.
+def iter_tracker_duplicates(config, stored=None, dropped=None):
+    rows = config.tracker_db_conn.execute(
+        "SELECT d.drive, d.file, d.hash, d.mtime, d.size, d.idx, o.drive, o.file, o.idx FROM backutil_tracker d "
+        "LEFT JOIN backutil_tracker o ON o.file = d.dup_of AND o.dup_of IS NULL WHERE d.dup_of IS NOT NULL;")
+    to_store = None
+    earlier = []
+    for drive, file, file_hash, mtime, size, index, ref_drive, ref, ref_index in rows:
+        if stored is None:
+            if ref is not None:
+                yield drive, file, file_hash, mtime, size, ref_drive, ref
+            elif dropped is not None:
+                dropped.append(file)
+            continue
+        details = stored.get(file_hash)
+        if details is not None:
+            yield drive, file, file_hash, mtime, size, details['drive'], details['file']
+            continue
+        if to_store is None:
+            to_store = set(config.files_to_back_up)
+        if ref is None or ref_index in to_store:
+            if dropped is not None:
+                dropped.append(file)
+        elif index is not None:
+            earlier.append((index, ref_drive, ref))
+    if not earlier:
+        return
+    # Of the duplicates of earlier content, only the paths the catalog doesn't have yet
+    from change_detector import find_changed_files
+    store = config.backup_files
+    try:
+        new = set(find_changed_files(store, (index for index, ref_drive, ref in earlier), config, by="file"))
+    except sqlite3.OperationalError:
+        new = None
+    for index, ref_drive, ref in earlier:
+        if new is None or index in new:
+            yield store.record(index) + (ref_drive, ref)
+
+# Catalog rows (file, hash, mtime, size, ref, member key) for the backed up files, keyed to their
+# path in the archive, and the duplicates that reference them (see iter_tracker_duplicates)
+def catalog_rows(config, backed_up_items, stored=None):
+    for key, value in backed_up_items:
+        member_key = staging_relative_path(value['drive'], value['file']).replace("\\", "/")
+        yield (value['file'], key, value['mtime'], value['size'], None, member_key)
+    for drive, filename, key, mtime, size, ref_drive, ref in iter_tracker_duplicates(config, stored):
+        yield (filename, key, mtime, size, ref, None)
+
+# Record this backup in the catalog, with where its archive holds every stored file
+def write_backup_to_catalog(config, backed_up_items, archive_path, kind, members=None, stored=None):
+    if members is None:
+        try:
+            members = read_archive_members(archive_path)
+        except Exception as err:
+            log(f"Couldn't read the member offsets of {archive_path}: {err}", "Warning")
+            members = {}
+    manage_previous_db(config, "open")
+    written = write_run(config.previous_db_conn, config.backup_time, kind, os.path.basename(archive_path),
+                        config.hash_algorithm, catalog_rows(config, backed_up_items, stored), members)
+    manage_previous_db(config, "close")
+    log(f"Recorded {written} files and {len(members)} archive members in the catalog.", "Success")
+
+# duplicates.csv as bytes, telling where the content of every duplicate path is stored (in this
+# archive, or in an earlier one for new paths of older content), or None when the backup has no
+# duplicates. stored as for iter_tracker_duplicates.
+def duplicates_manifest(config, stored=None):
+    dropped = []
+    rows = [(staging_relative_path(drive, file), staging_relative_path(ref_drive, ref))
+            for drive, file, file_hash, mtime, size, ref_drive, ref in iter_tracker_duplicates(config, stored, dropped)]
+    if dropped:
+        log(f"{len(dropped)} duplicate files are not backed up, the copy of their content failed: "
+            + ", ".join(dropped[:20]) + (" ..." if len(dropped) > 20 else ""), "Warning")
+    if not rows:
+        return None
+    text = io.StringIO(newline='')
+    writer = csv.writer(text)
+    writer.writerow(("path", "stored_as"))
+    writer.writerows(rows)
+    return text.getvalue().encode('utf-8')
+
+# Write duplicates.csv into the session folder so it ends up in the archive
+def write_duplicates_manifest(config, session_folder, stored=None):
+    manifest = duplicates_manifest(config, stored)
+    if manifest is None:
+        return
+    try:
+        with open(os.path.join(session_folder, DUPLICATES_MANIFEST), 'wb') as f:
+            f.write(manifest)
+        paths = manifest.count(b"\n") - 1
+        log(f"Recorded {paths} duplicate paths in {DUPLICATES_MANIFEST}.", "Success")
+    except OSError as err:
+        log(f"Error writing {DUPLICATES_MANIFEST}: {err}", "Warning")
+
+# Files to copy, largest first, shared by the copy threads: a thread that is done with a file
+# takes the next one, so a huge file never leaves a fixed slice of work queued behind it.
+# Counts the files and bytes every thread copied.
+class CopyWorkQueue:
+    def __init__(self, store, indices):
+        self.store = store
+        self.indices = sorted(indices, key=store.sizes.__getitem__, reverse=True)
+        self.lock = threading.Lock()
+        self.position = 0
+        self.copied = {}
+
+    # Next file to copy, None when the queue is empty
+    def take(self):
+        with self.lock:
+            if self.position >= len(self.indices):
+                return None
+            self.position += 1
+            return self.indices[self.position - 1]
+
+    def done(self, threadnum, index):
+        with self.lock:
+            files, size = self.copied.get(threadnum, (0, 0))
+            self.copied[threadnum] = (files + 1, size + self.store.sizes[index])
+
+    def report(self):
+        for threadnum in sorted(self.copied):
+            files, size = self.copied[threadnum]
+            log(f"Copy thread {threadnum}: {files} files, {size / 1048576:.0f} MB", "INFORMA")
+        methods = ", ".join(f"{name} {count}" for name, count in sorted(method_counts().items()))
+        log(f"Files copied per copy method: {methods}", "INFORMA")
+
+# Copy files to staging folder, taking them from the shared work queue until it is empty.
+# The layout has already created the destination folders.
+def copy_files_pool(threadnum, work_queue, layout, config):
     return_dict_thread = {}
-    buffer_size = config.buffer_size  # 1 MB
-    for backup_file in files_to_back_up_thread:
-        backup_path = backup_file[1]
-        if backup_path.startswith(prefix):
-            path = backup_path[len(prefix):]
-        if "\\" in path:
-            path = path[path.index("\\") + 1:]
-        dir_path = os.path.dirname(path)
-        drive = backup_file[0]
-        drive = drive.replace(":", "")
+    store = config.backup_files
+    while (index := work_queue.take()) is not None:
+        backup_file = store.record(index)
         src_path_in_snapshot = backup_file[1]
-        dst_path_in_snapshot = os.path.join(staging_folder, backup_time, drive, dir_path)
-        dst_path_in_snapshot2 = os.path.join(staging_folder, backup_time, drive, path)
         try:
-            os.makedirs(dst_path_in_snapshot, exist_ok=True)
-            shutil.copy(src_path_in_snapshot, dst_path_in_snapshot2)
-            # with open(src_path_in_snapshot, "rb") as src_file, open(dst_path_in_snapshot2, "wb") as dst_file:
-            #     shutil.copyfileobj(src_file, dst_file, buffer_size)
+            copy_file(src_path_in_snapshot, layout.destination(store, index), config.buffer_size)
             # Log the successfully copied file
-            # log(f"Successfully copied file: {os.path.basename(dst_path_in_snapshot2)}", "Success")
+            # log(f"Successfully copied file: {os.path.basename(src_path_in_snapshot)}", "Success")
             return_dict_thread[backup_file[2]] = {
                 "status":"Y",
+                "drive":backup_file[0],
+                "file":backup_file[1],
                 "mtime":backup_file[3],
                 "size":backup_file[4],
                 }
+            work_queue.done(threadnum, index)
         except FileNotFoundError:
             log(f"Error: Path not found in the latest VSS snapshot: {src_path_in_snapshot}", "failure")
             pass
@@ -202,6 +570,107 @@ def copy_files_pool(threadnum, files_to_back_up_thread, staging_folder, backup_t
            pass
     return return_dict_thread
 
+# Work out which files the one-pass copy still has to read: files with a cached hash, and with
+# size_prefilter the files that may have a duplicate, are hashed and deduplicated up front; the
+# rest are hashed on the way. Returns (hash_cache, first_by_hash, duplicates, to_copy).
+def plan_one_pass_copy(indices, config):
+    store = config.backup_files
+    from hash_cache import open_hash_cache
+    hash_cache = open_hash_cache(config) if config.hash_cache else None
+    first_by_hash = {}
+    duplicates = []
+    to_copy = []
+    not_hashed = []
+    for index in indices:
+        file_hash = hash_cache.lookup(store, index) if hash_cache is not None else None
+        if file_hash is None:
+            not_hashed.append(index)
+            continue
+        store.hashes[index] = file_hash
+        if first_by_hash.setdefault(file_hash, index) != index:
+            duplicates.append(index)
+        else:
+            to_copy.append(index)
+    if config.size_prefilter and not_hashed:
+        # Only possible duplicates are hashed up front so they are never copied,
+        # everything else is hashed on the way to the staging folder
+        from dedup_prefilter import find_duplicate_candidates
+        candidates, not_hashed = find_duplicate_candidates(store, not_hashed, to_copy, config)
+        for index, file_hash, exc in hash_files(store, candidates, config):
+            if exc is not None:
+                # The copy will hit the same error and report it
+                not_hashed.append(index)
+                continue
+            store.hashes[index] = file_hash
+            if hash_cache is not None:
+                hash_cache.store(store, index, file_hash)
+            if first_by_hash.setdefault(file_hash, index) != index:
+                duplicates.append(index)
+            else:
+                to_copy.append(index)
+    to_copy.extend(not_hashed)
+    return hash_cache, first_by_hash, duplicates, to_copy
+
+# Record a hash computed during the copy. Returns False when the file turned out to duplicate
+# one already copied, after adding it to duplicates.
+def index_copied_hash(store, index, file_hash, first_by_hash, duplicates, hash_cache):
+    store.hashes[index] = file_hash
+    if hash_cache is not None:
+        hash_cache.store(store, index, file_hash)
+    if first_by_hash.setdefault(file_hash, index) != index:
+        duplicates.append(index)
+        return False
+    return True
+
+# Full backup with fused_copy_hash: instead of a hashing pass followed by a copy pass, every
+# file is hashed while it is copied to the staging folder. Files deduplicated by
+# plan_one_pass_copy are never copied, duplicates only found after the copy are deleted again.
+# Returns {hash: details} like copy_files_pool.
+def copy_and_hash_files(indices, staging_folder, backup_time, config):
+    log("Copying and hashing files in one pass...", "Attempt")
+    start_time_copy = datetime.now()
+    store = config.backup_files
+    hash_cache, first_by_hash, duplicates, to_copy = plan_one_pass_copy(indices, config)
+    layout = StagingLayout(os.path.join(staging_folder, backup_time))
+    layout.prepare(store, to_copy)
+
+    def copy_one(index):
+        dst = layout.destination(store, index)
+        if store.hashes[index] is not None:
+            copy_file(store.path(index), dst, config.buffer_size)
+            return dst, None
+        return dst, copy_and_hash_file(store.path(index), dst, config.buffer_size, config.hash_algorithm)
+
+    return_dict = {}
+    stored = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.max_threads) as executor:
+        # The executor hands out work in submission order, largest files first
+        to_copy.sort(key=store.sizes.__getitem__, reverse=True)
+        futures = {executor.submit(copy_one, index): index for index in to_copy}
+        for future in concurrent.futures.as_completed(futures):
+            index = futures[future]
+            try:
+                dst, file_hash = future.result()
+            except FileNotFoundError:
+                log(f"Error: Path not found in the latest VSS snapshot: {store.path(index)}", "failure")
+                continue
+            except Exception as e:
+                log(f"Error: {e}", "failure")
+                continue
+            if file_hash is not None and not index_copied_hash(store, index, file_hash, first_by_hash, duplicates, hash_cache):
+                os.remove(dst)
+                continue
+            stored.append(index)
+            return_dict[store.hashes[index]] = {"status": "Y", "drive": store.drive(index), "file": store.path(index), "mtime": store.mtimes[index], "size": store.sizes[index]}
+    if hash_cache is not None:
+        hash_cache.close()
+    record_content_index(config, stored, duplicates, first_by_hash)
+    hash_path_stats.report()
+    duration = datetime.now() - start_time_copy
+    duration_str = str(duration).split('.')[0]  # Remove the fractional seconds
+    log(f"Copied and hashed {len(stored)} files in one pass, duration: {duration_str}", "Success")
+    return return_dict
+
 def check_free_space(backup_drive, backup_data_size):
     drive, rest = os.path.splitdrive(backup_drive)
     disk_usage = shutil.disk_usage(drive)
@@ -256,16 +725,69 @@ def update_config_file(file_path,section,key,value):
     with open(file_path, 'w') as configfile:
         config.write(configfile)
 
+# Optional tuning keys in the [BACKUP] section, each one falls back to a default
+def load_tuning_options(config, config_file):
+    # Listing folders mostly waits on the disk, twice the threads keeps it busy
+    config.scan_workers = int(config_file.get('BACKUP', 'scan_workers', fallback=2 * config.max_threads))
+    config.exclude_specs = load_exclude_specs(config_file)
+    config.streaming_pipeline = config_file.getboolean('BACKUP', 'streaming_pipeline', fallback=False)
+    config.pipeline_queue_size = int(config_file.get('BACKUP', 'pipeline_queue_size', fallback=1024))
+    # A streamed backup keeps its tracker in a private temporary database on disk (SQLite's empty
+    # file name, removed when it is closed), so memory doesn't grow with the number of files
+    if config.streaming_pipeline:
+        config.tracker_db_name = ""
+    config.hash_cache = config_file.getboolean('BACKUP', 'hash_cache', fallback=True)
+    config.hash_cache_max_age = int(config_file.get('BACKUP', 'hash_cache_max_age', fallback=90))
+    config.paranoid_sample_percent = float(config_file.get('BACKUP', 'paranoid_sample_percent', fallback=1))
+    config.hash_engine = config_file.get('BACKUP', 'hash_engine', fallback='adaptive')
+    config.hash_processes = int(config_file.get('BACKUP', 'hash_processes', fallback=0))
+    config.small_file_limit = int(config_file.get('BACKUP', 'small_file_limit', fallback=1048576))
+    config.mmap_threshold = int(config_file.get('BACKUP', 'mmap_threshold', fallback=67108864))
+    config.fused_copy_hash = config_file.getboolean('BACKUP', 'fused_copy_hash', fallback=True)
+    config.size_prefilter = config_file.getboolean('BACKUP', 'size_prefilter', fallback=True)
+    config.change_merge_rows = int(config_file.get('BACKUP', 'change_merge_rows', fallback=20000000))
+    config.catalog_vacuum_days = int(config_file.get('BACKUP', 'catalog_vacuum_days', fallback=7))
+    config.direct_archive = config_file.getboolean('BACKUP', 'direct_archive', fallback=False)
+    config.zip_compression_level = int(config_file.get('BACKUP', 'zip_compression_level', fallback=6))
+    config.zip_workers = int(config_file.get('BACKUP', 'zip_workers', fallback=0))
+    config.zip_skip_incompressible = config_file.getboolean('BACKUP', 'zip_skip_incompressible', fallback=True)
+    config.lz4_workers = int(config_file.get('BACKUP', 'lz4_workers', fallback=0))
+    config.lz4_block_size = int(config_file.get('BACKUP', 'lz4_block_size', fallback=4194304))
+    config.zstd_level = int(config_file.get('BACKUP', 'zstd_level', fallback=3))
+    config.zstd_threads = int(config_file.get('BACKUP', 'zstd_threads', fallback=0))
+    config.zstd_dictionary = config_file.getboolean('BACKUP', 'zstd_dictionary', fallback=False)
+    config.zstd_dict_size = int(config_file.get('BACKUP', 'zstd_dict_size', fallback=112640))
+    config.zstd_dict_samples = int(config_file.get('BACKUP', 'zstd_dict_samples', fallback=2000))
+    # auto picks zip or tar.lz4 from the backup size; zip, tar.lz4 and tar.zst force a format
+    archive_format = config_file.get('BACKUP', 'archive_format', fallback='auto').strip().lower().lstrip('.')
+    config.archive_format = archive_format if archive_format in ('auto', 'zip') else '.' + archive_format
+    if config.archive_format not in ARCHIVE_FORMATS:
+        log(f"Unknown archive_format {archive_format}, choosing the format from the backup size.", "Warning")
+        config.archive_format = 'auto'
+    elif config.archive_format == '.tar.zst':
+        try:
+            import zstandard
+        except ImportError as err:
+            log(f"Can't use archive_format tar.zst ({err}), choosing the format from the backup size.", "Warning")
+            config.archive_format = 'auto'
+    config.archive_verify = config_file.get('BACKUP', 'archive_verify', fallback='quick').strip().lower()
+    if config.archive_verify not in VERIFY_MODES:
+        log(f"Unknown archive_verify {config.archive_verify}, using quick.", "Warning")
+        config.archive_verify = 'quick'
+    config.archive_verify_sample = int(config_file.get('BACKUP', 'archive_verify_sample', fallback=32))
+    config.archive_verify_workers = int(config_file.get('BACKUP', 'archive_verify_workers', fallback=0))
+    config.hash_algorithm = config_file.get('BACKUP', 'hash_algorithm', fallback=DEFAULT_HASH_ALGORITHM)
+    try:
+        new_hash(config.hash_algorithm)
+    except (ValueError, ImportError) as err:
+        log(f"Can't use hash_algorithm {config.hash_algorithm} ({err}), using {DEFAULT_HASH_ALGORITHM}.", "Warning")
+        config.hash_algorithm = DEFAULT_HASH_ALGORITHM
+
 def get_total(config):
+    store = config.backup_files
     num_files = len(config.files_to_back_up)
-    config.total_size = 0
-    unique_folders = set()
-    for file_info in config.files_to_back_up:
-            file_size = file_info[4]  
-            file_path = file_info[1]
-            parent_dir = os.path.dirname(file_path)
-            config.total_size += int(file_size)
-            unique_folders.add(parent_dir)
+    config.total_size = store.total_size(config.files_to_back_up)
+    unique_folders = {store.dir_idx[index] for index in config.files_to_back_up}
     import vss_snapshot
     total_size_gb = vss_snapshot.format_folder_size(config.total_size)
-    log(f"Backed up {num_files} files and {len(unique_folders)} folders ({total_size_gb})","Attempt")
\ No newline at end of file
+    log(f"Backed up {num_files} files and {len(unique_folders)} folders ({total_size_gb})","Attempt")
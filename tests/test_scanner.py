@@ -0,0 +1,50 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rules import ExcludeRules
+from scanner import scan_tree
+
+class ScanTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="backutil_test_")
+        # log() writes backutil_log.txt to the working folder
+        self.cwd = os.getcwd()
+        os.chdir(self.root)
+        self.top = os.path.join(self.root, "docs")
+        for folder in ("", "reports", os.path.join("reports", "2026"), "node_modules"):
+            os.makedirs(os.path.join(self.top, folder), exist_ok=True)
+            path = os.path.join(self.top, folder, "file.txt")
+            with open(path, "wb") as f:
+                f.write(folder.encode() or b"top")
+            os.utime(path, (1700000000, 1700000000))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def files(self, rules=None):
+        return sorted((os.path.relpath(path, self.top), mtime, size)
+                      for dir_path, files, subdirs, num_dirs in scan_tree(self.top, 2, rules)
+                      for path, name, mtime, size, file_id in files)
+
+    def test_every_file_with_its_stat(self):
+        self.assertEqual(self.files(), [
+            ("file.txt", 1700000000, 3),
+            (os.path.join("node_modules", "file.txt"), 1700000000, len("node_modules")),
+            (os.path.join("reports", "2026", "file.txt"), 1700000000, len(os.path.join("reports", "2026"))),
+            (os.path.join("reports", "file.txt"), 1700000000, len("reports")),
+        ])
+
+    # A folder matched by a dir rule is not read at all
+    def test_pruned_folder(self):
+        rules = ExcludeRules([("dev_folders", "dir:node_modules")])
+        self.assertNotIn(os.path.join("node_modules", "file.txt"), [path for path, mtime, size in self.files(rules)])
+        self.assertEqual(list(rules.summary())[0][3], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,6 +4,8 @@ import subprocess
 from datetime import datetime
 import time
 from submain import log
+from scanner import scan_tree, format_scan_rate
+from rules import ExcludeRules
 
 def get_vss_snapshots(snapshot_id):
     cmd = f'vssadmin list shadows /shadow={snapshot_id}'
@@ -98,7 +100,9 @@ def remove_all_symbolic_links(link_directory):
             remove_symbolic_link(item_path)
 
 # Generate list of all files/folders
-def get_all_files_to_backup(volumes, snapshot_ids, config):
+# Yields (drive, file_path, mtime, size, file_id) for every file to back up while the scan is running,
+# so the streaming pipeline can start hashing before the whole tree has been listed.
+def iter_files_to_backup(volumes, snapshot_ids, config):
     start_time_list = datetime.now()
     link_directory = "c:\\mount"  
 
@@ -106,48 +110,40 @@ def get_all_files_to_backup(volumes, snapshot_ids, config):
     create_symbolic_links(snapshot_ids, link_directory)
 
     log("Generating list of files in backup directories...", "Attempt")
+    rules = ExcludeRules(config.exclude_specs)
+    scan_start = time.perf_counter()
+    num_files = 0
     for volume, paths in volumes.items():
         for path in paths:
             drive, rest = os.path.splitdrive(path)
             symlink_path = os.path.join(link_directory, f"snapshot_{volume.replace(':', '')}")
 
             snap_path = os.path.join(symlink_path, rest.lstrip('\\'))
-            file_hashes = {}
-
-            for root, directories, filenames in os.walk(snap_path):
-                config.num_folders += len(directories)
-
-                for filename in filenames:
-                    file_path = os.path.join(root, filename)
-                    long_file_path = os.path.abspath(file_path)
-                    # For Windows systems
-                    if os.name == 'nt':
-                        long_file_path = f"\\\\?\\{long_file_path}"
-                    
-                    if not os.access(file_path, os.R_OK):
-                        log(f"Error: Insufficient permissions to read file: {file_path}", "Failure")
+
+            # Folders are listed in parallel with os.scandir, the stat data comes with the listing
+            for root, files, directories, num_dirs in scan_tree(snap_path, config.scan_workers, rules):
+                config.num_folders += num_dirs
+
+                for file_path, filename, mtime, size, file_id in files:
+                    num_files += 1
+                    # Skip temporary files and anything else matched by the exclude rules
+                    if rules.exclude_file(file_path, filename, mtime, size):
                         continue
-                    # Skip temporary files
-                    try:
-                        if filename.endswith(('.tmp', '.temp', '.swp','.ini','.lnk','.db','.rdp')) or filename.startswith(('~$')):
-                            continue
-                            # Add the file to the backup list
-                        config.backup_files[file_path] = {
-                                'drive': drive,
-                                'mtime': os.path.getmtime(file_path),
-                                'size': os.path.getsize(file_path)
-                            }
-                        size = os.path.getsize(file_path)
-                        config.total_size += size
-                    except FileNotFoundError:
-                        log(f"Error: File not found or inaccessible: {file_path}", "Failure")
-                    except Exception as e:
-                        log(f"Error processing file {file_path}: {e}", "Failure")
+                    yield drive, file_path, mtime, size, file_id
     log("File list generated successfully.", "Success")
+    log("Scanned " + format_scan_rate(num_files, time.perf_counter() - scan_start), "Success")
+    for name, files, size, folders in rules.summary():
+        log(f"Exclude rule {name}: {files} files ({format_folder_size(size)}) and {folders} folders skipped.", "Success")
     end_time_list = datetime.now()
     duration = end_time_list - start_time_list
     duration_str = str(duration).split('.')[0]  # Remove the fractional seconds
     log('Generating list of files in backup directories Duration: ' + duration_str , "Success")
+
+def get_all_files_to_backup(volumes, snapshot_ids, config):
+    for drive, file_path, mtime, size, file_id in iter_files_to_backup(volumes, snapshot_ids, config):
+        # Add the file to the backup list
+        config.backup_files.add(drive, file_path, mtime, size, file_id)
+        config.total_size += size
     return config.backup_files
 
 
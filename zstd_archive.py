@@ -0,0 +1,127 @@
+import os
+import struct
+import tarfile
+from datetime import datetime
+from submain import log
+from catalog import open_catalog, write_dictionary
+
+# .tar.zst archives: the tar stream of the session folder compressed by zstd's own worker threads
+# at zstd_level. With zstd_dictionary a dictionary is trained from a sample of the small files
+# first; it is stored in the catalog and in a skippable frame at the start of the archive, which
+# every zstd decoder passes over, so the archive can still be restored without the catalog
+# (`zstd -d -D <dictionary>` with the frame's contents, or open_zstd_archive()).
+
+# One of the skippable frame magic numbers (0x184D2A50-0x184D2A5F)
+DICTIONARY_FRAME_MAGIC = 0x184D2A5D
+# Only files up to this size are dictionary samples, and only this much of each is used
+SAMPLE_MAX_SIZE = 128 * 1024
+
+def _zstandard():
+    # Optional dependency, only needed for archive_format = tar.zst
+    import zstandard
+    return zstandard
+
+# Train a dictionary from up to sample_count small files out of files, given as (path, size) and
+# spread over the whole list. Returns None when there aren't enough samples to train one.
+def train_dictionary(files, dict_size, sample_count):
+    zstandard = _zstandard()
+    small = [path for path, size in files if 0 < size <= SAMPLE_MAX_SIZE]
+    if not small:
+        return None
+    samples = []
+    for path in small[::max(len(small) // sample_count, 1)][:sample_count]:
+        try:
+            with open(path, 'rb') as f:
+                samples.append(f.read(SAMPLE_MAX_SIZE))
+        except OSError:
+            continue
+    try:
+        dictionary = zstandard.train_dictionary(dict_size, samples, threads=-1)
+    except zstandard.ZstdError as err:
+        log(f"Couldn't train a zstd dictionary from {len(samples)} samples: {err}", "Warning")
+        return None
+    log(f"Trained zstd dictionary {dictionary.dict_id()} ({len(dictionary.as_bytes()) / 1024:.0f} KB) "
+        f"from {len(samples)} sample files.", "Success")
+    return dictionary
+
+# File object tarfile writes the archive through
+class ZstdArchiveWriter:
+    def __init__(self, archive_path, level=3, threads=0, dictionary=None):
+        zstandard = _zstandard()
+        self.file = open(archive_path, 'wb')
+        if dictionary is not None:
+            data = dictionary.as_bytes()
+            self.file.write(struct.pack('<II', DICTIONARY_FRAME_MAGIC, len(data)))
+            self.file.write(data)
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads or -1, dict_data=dictionary)
+        self.writer = compressor.stream_writer(self.file)
+        # Uncompressed bytes written so far, tarfile uses it as the stream offset
+        self.position = 0
+
+    def write(self, data):
+        self.writer.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    # Ends the zstd frame and closes the archive file
+    def close(self):
+        if not self.writer.closed:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Readable decompressed stream of a .tar.zst, with the dictionary from its skippable frame if it has one
+def open_zstd_archive(archive_path):
+    zstandard = _zstandard()
+    f = open(archive_path, 'rb')
+    dictionary = None
+    header = f.read(8)
+    if len(header) == 8 and struct.unpack('<I', header[:4])[0] == DICTIONARY_FRAME_MAGIC:
+        dictionary = zstandard.ZstdCompressionDict(f.read(struct.unpack('<I', header[4:])[0]))
+    else:
+        f.seek(0)
+    return zstandard.ZstdDecompressor(dict_data=dictionary).stream_reader(f, closefd=True)
+
+# Keep the dictionary an archive was compressed with in the catalog
+def record_dictionary(config, archive_path, dictionary):
+    conn = open_catalog(config.previous_db_name)
+    try:
+        write_dictionary(conn, os.path.basename(archive_path), dictionary.dict_id(), dictionary.as_bytes())
+    finally:
+        conn.close()
+
+# Compress the session folder into a .tar.zst, the counterpart of create_lz4_file_from_folder
+def create_zstd_file_from_folder(src_dir, archive_path, config):
+    start_time_zst = datetime.now()
+    log("Creating zst file from folder: " + src_dir, "Attempt")
+    dictionary = None
+    if config.zstd_dictionary:
+        files = []
+        for dirpath, dirnames, filenames in os.walk(src_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                files.append((path, os.path.getsize(path)))
+        dictionary = train_dictionary(files, config.zstd_dict_size, config.zstd_dict_samples)
+    try:
+        with ZstdArchiveWriter(archive_path, config.zstd_level, config.zstd_threads, dictionary) as zst_file:
+            with tarfile.open(fileobj=zst_file, mode='w') as tar:
+                tar.add(src_dir, arcname=os.path.basename(src_dir))
+        if dictionary is not None:
+            record_dictionary(config, archive_path, dictionary)
+    except Exception as e:
+        log(f"zst file creation failed ({e}).", "Failure")
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+        return False
+    duration = datetime.now() - start_time_zst
+    duration_str = str(duration).split('.')[0]  # Remove the fractional seconds
+    ratio = os.path.getsize(archive_path) / zst_file.position if zst_file.position else 1
+    log(f"zst file created successfully ({ratio:.0%} of the tar stream), duration: {duration_str}", "Success")
+    return True